@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""A Bloom filter which can be stored in memcache."""
+
+from google.appengine.api import memcache
+
+from array import array
+
+import hashlib
+import math
+import struct
+import time
+
+# Memcache values are limited to 1MB, so the bits are stored in shards.
+SHARD_SIZE = 900 * 1024
+
+class BloomFilter(object):
+  """A set which can have false positives but no false negatives.
+
+  An item is hashed to several bit positions. Adding the item turns the bits
+  on, and an item is probably in the set if all of its bits are on.
+
+  Properties
+    size: Number of bits.
+    hashes: Number of bits per item.
+    bits: The bits, in an array of bytes.
+    count: Number of items added.
+    version: Distinguishes the shards in memcache from those of other copies.
+  """
+
+  def __init__(self, size, hashes, bits=None, count=0, version=None):
+    self.size = size
+    self.hashes = hashes
+    self.bits = bits or array('B', [0]) * (size / 8)
+    self.count = count
+    self.version = version or str(int(time.time() * 1000))
+
+  def with_capacity(capacity, error_rate=0.01):
+    """Builds a BloomFilter big enough to hold a number of items.
+
+    Parameters
+      capacity: The number of items.
+      error_rate: The false positive rate when the filter holds capacity items.
+    Returns
+      An empty BloomFilter.
+    """
+    capacity = max(1, capacity)
+    size = -capacity * math.log(error_rate) / math.log(2) ** 2
+    size = max(8, int(math.ceil(size / 8)) * 8)
+    hashes = max(1, int(round(size / float(capacity) * math.log(2))))
+    return BloomFilter(size, hashes)
+  with_capacity = staticmethod(with_capacity)
+
+  def positions(self, item):
+    """Returns the bit positions of an item.
+
+    Parameters
+      item: A string.
+    Returns
+      A list of bit positions.
+    """
+    if isinstance(item, unicode):
+      item = item.encode('utf8')
+    first, second = struct.unpack('<QQ', hashlib.md5(item).digest())
+    return [(first + i * second) % self.size for i in xrange(self.hashes)]
+
+  def add(self, item):
+    """Adds an item to the filter.
+
+    Parameters
+      item: A string.
+    Returns
+      The set of shards which changed.
+    """
+    changed = set()
+    for position in self.positions(item):
+      index, mask = position >> 3, 1 << (position & 7)
+      if not self.bits[index] & mask:
+        self.bits[index] |= mask
+        changed.add(index / SHARD_SIZE)
+    self.count += 1
+    return changed
+
+  def __contains__(self, item):
+    for position in self.positions(item):
+      if not self.bits[position >> 3] & 1 << (position & 7):
+        return False
+    return True
+
+  def error_rate(self):
+    """Returns the expected false positive rate for the items added."""
+    filled = 1 - math.exp(-self.hashes * self.count / float(self.size))
+    return filled ** self.hashes
+
+  def save(self, name, shards=None):
+    """Stores the filter in memcache. Copies loaded at the same time overwrite
+    each other's bits when saved, so callers which change a stored filter
+    must not save concurrently.
+
+    Parameters
+      name: The memcache key.
+      shards: The shards to store. All of them are stored if None.
+    Returns
+      True if the filter was stored.
+    """
+    shardcount = (len(self.bits) + SHARD_SIZE - 1) / SHARD_SIZE
+    if shards is None:
+      shards = range(shardcount)
+    values = {}
+    for shard in shards:
+      values['%s:%d' % (self.version, shard)] = \
+          self.bits[shard * SHARD_SIZE:(shard + 1) * SHARD_SIZE].tostring()
+    if memcache.set_multi(values, key_prefix=name + ':'):
+      return False
+    meta = {
+        'size': self.size,
+        'hashes': self.hashes,
+        'count': self.count,
+        'version': self.version,
+        'shards': shardcount,
+        }
+    return memcache.set(name, meta)
+
+  def load(name):
+    """Reads a filter stored in memcache.
+
+    Parameters
+      name: The memcache key.
+    Returns
+      The BloomFilter, or None if it is not in memcache.
+    """
+    meta = memcache.get(name)
+    if meta is None:
+      return None
+    keys = ['%s:%d' % (meta['version'], shard)
+            for shard in range(meta['shards'])]
+    values = memcache.get_multi(keys, key_prefix=name + ':')
+    if len(values) < len(keys):
+      return None
+    bits = array('B')
+    for key in keys:
+      bits.fromstring(values[key])
+    return BloomFilter(
+        meta['size'], meta['hashes'], bits, meta['count'], meta['version']
+        )
+  load = staticmethod(load)
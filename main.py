@@ -4,44 +4,258 @@ from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.api import urlfetch
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from django.utils import simplejson
+from django.utils.simplejson.encoder import encode_basestring_ascii
 
 from models import *
 
+import cgi
+import email.utils
+import hashlib
 import os
 import wsgiref.handlers
 import re
 import urllib
 import logging
-
-NAME_RE = re.compile("@(\w+)")
+import time
+
+# Seconds a rendered page is cached, if its topic doesn't change first.
+PAGE_CACHE_TIME = 3600
+# Formats answered with 304 Not Modified when the client's copy is current.
+CONDITIONAL_FORMATS = ['json', 'ndjson', 'rss']
+# Headers of a rendered page which are cached along with it.
+CACHED_HEADERS = ['Content-Type', 'X-Next-Cursor', 'Link']
+# Tweets on a page, unless set by the limit parameter, and the most allowed.
+PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+# Cursors of pages in the orders kept by TopicSnapshot begin with this, and
+# how their dates are written. See keyset_cursor.
+KEYSET_PREFIX = 'after:'
+KEYSET_TIME = '%Y-%m-%dT%H:%M:%S'
+
+# A Tweet written as JSON by write_json, with the fields in this order.
+JSON_TWEET = (
+    '{"content": %s, "created_at": %s, "pic_url": %s, "author": %s, '
+    '"source_id": %s, "source_url": %s}'
+    )
+
+def write_json(out, tweets, lines=False):
+  """Writes Tweets as a JSON array, or as one JSON object per line. Each
+  Tweet is written as soon as it is encoded, by filling in JSON_TWEET.
+
+  Parameters
+    out: A file-like object.
+    tweets: A list of Tweets.
+    lines: Whether to write newline delimited JSON instead of an array.
+  """
+  quote = encode_basestring_ascii
+  if not lines:
+    out.write('[')
+  for index, tweet in enumerate(tweets):
+    if index and not lines:
+      out.write(', ')
+    out.write(JSON_TWEET % (
+        quote(unicode(tweet.content)),
+        quote(tweet.created_at.isoformat() + 'Z'),
+        quote(unicode(tweet.pic_url)),
+        quote(unicode(tweet.author)),
+        quote(unicode(tweet.source_id)),
+        quote(tweet.source_url()),
+        ))
+    if lines:
+      out.write('\n')
+  if not lines:
+    out.write(']')
+
+def keyset_cursor(order, tweets, skipped=()):
+  """Returns the cursor of the page after Tweets, in one of the orders kept
+  by TopicSnapshot. Instead of a datastore cursor, it holds the value of the
+  order's property on the last Tweet, and the IDs of the Tweets shown which
+  share that value, so that it can be made without a query.
+
+  Parameters
+    order: One of TopicSnapshot.ORDERS.
+    tweets: The Tweets of the page, in order.
+    skipped: The IDs skipped to reach the page. See read_keyset.
+  Returns
+    A string beginning with KEYSET_PREFIX.
+  """
+  name = order.lstrip('-')
+  value = getattr(tweets[-1], name)
+  ids = [tweet.source_id for tweet in tweets if getattr(tweet, name) == value]
+  # A page of Tweets which all share the value continues past the IDs
+  # skipped before it too.
+  if len(ids) == len(tweets):
+    ids.extend(skipped)
+  if isinstance(value, datetime):
+    value = value.strftime(KEYSET_TIME)
+  return '%s%s %s' % (KEYSET_PREFIX, value, ','.join(ids))
+
+def read_keyset(order, cursor):
+  """Decodes a cursor made by keyset_cursor.
+
+  Parameters
+    order: The order of the page.
+    cursor: A string beginning with KEYSET_PREFIX.
+  Returns
+    A tuple of the filter of the page's query, its value, and the set of IDs
+    to skip.
+  Raises
+    ValueError if the cursor is not valid for the order.
+  """
+  if order not in TopicSnapshot.ORDERS:
+    raise ValueError("No keyset cursors in order %s" % order)
+  value, ids = cursor[len(KEYSET_PREFIX):].rsplit(' ', 1)
+  name = order.lstrip('-')
+  if name == 'created_at':
+    value = datetime.strptime(value, KEYSET_TIME)
+  return name + ' <=', value, set(ids.split(','))
 
 class TopicDetail(webapp.RequestHandler):
   """Handles list of tweets in a topic."""
 
   def get(self, topic_name, format='html'):
-    """Retrieve an HTML page of tweets."""
+    """Retrieve an HTML page of tweets.
+
+    Pages hold limit tweets, and continue from the cursor given as cursor.
+    The cursor of the next page is returned in the X-Next-Cursor and Link
+    headers, and linked to from the html and rss formats. In the orders kept
+    by TopicSnapshot, the first page is read from the snapshot and cursors
+    are keysets, see keyset_cursor. Other orders use datastore cursors.
+
+    Rendered pages are cached in memcache with the generation of their topic,
+    see touch_topics, and only served while the generation is the same. A
+    cached page costs one memcache call and no datastore reads.
+    """
     topic_name = urllib.unquote(topic_name)
     topic_name = topic_name.decode('utf8')
     order = self.request.get("order") or "-created_at"
+    cursor = self.request.get("cursor")
+    try:
+      limit = int(self.request.get("limit") or PAGE_SIZE)
+    except ValueError:
+      self.error(400) # Bad request
+      return
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    keyset = None
+    if cursor.startswith(KEYSET_PREFIX):
+      try:
+        keyset = read_keyset(order, cursor)
+      except ValueError:
+        self.error(400) # Bad cursor
+        return
 
     tokens = Topic.tokenize(topic_name)
     path = Topic.create_path(tokens)
-    topic = Topic.get(db.Key.from_path(*path))
+    key = db.Key.from_path(*path)
+
+    generation_key = 'generation:%s' % key
+    # Pages show the path and the parameters they were asked with.
+    page_key = 'page:%s:%s' % (key, hashlib.md5(repr((
+        self.request.path, self.request.get("order"),
+        self.request.get("limit"), cursor
+        ))).hexdigest())
+    cached = memcache.get_multi([generation_key, page_key])
+    generation = cached.get(generation_key)
+
+    def not_modified():
+      if format not in CONDITIONAL_FORMATS:
+        return False
+      etag = '"%s"' % hashlib.md5('%s:%r' % (page_key, generation)).hexdigest()
+      if self.validate(etag, generation):
+        self.response.set_status(304)
+        return True
+      return False
+
+    # A cached page was rendered for a topic which exists.
+    page = cached.get(page_key)
+    if page and generation is not None and page['generation'] == generation:
+      if not_modified():
+        return
+      for name, value in page['headers'].items():
+        self.response.headers[name] = value
+      self.response.out.write(page['body'])
+      return
+
+    # The first page in an order kept by the topic's snapshot is read from
+    # it, with the topic in one get.
+    if not cursor and limit <= SNAPSHOT_SIZE and order in TopicSnapshot.ORDERS:
+      topic, snapshot = db.get([
+          key, db.Key.from_path('TopicSnapshot', str(key))
+          ])
+    else:
+      topic, snapshot = Topic.get(key), None
 
     if not topic:
       self.error(404)
       return
 
-    tweets = []
+    if generation is None:
+      generation = time.time()
+      if not memcache.add(generation_key, generation):
+        generation = memcache.get(generation_key) or generation
+    if not_modified():
+      return
+
+    def fetch_page(query):
+      if cursor and not keyset:
+        query.with_cursor(cursor)
+      tweets = query.fetch(limit)
+      if len(tweets) == limit:
+        return tweets, query.cursor()
+      return tweets, None
+
+    def fetch_keyset(query):
+      skipped = ()
+      if keyset:
+        operator, value, skipped = keyset
+        query.filter(operator, value)
+      tweets = query.fetch(limit + len(skipped))
+      more = len(tweets) == limit + len(skipped)
+      tweets = [tweet for tweet in tweets if tweet.source_id not in skipped]
+      tweets = tweets[:limit]
+      if more and tweets:
+        return tweets, keyset_cursor(order, tweets, skipped)
+      return tweets, None
+
+    def read_snapshot(snapshot):
+      held = snapshot.tweets(order)
+      tweets = held[:limit]
+      if snapshot.complete and len(held) <= limit:
+        return tweets, None
+      if len(tweets) == limit:
+        return tweets, keyset_cursor(order, tweets)
+      # Too few of the first Tweets are held.
+      return fetch_keyset(topic.tweets.order(order))
+
     messages = []
     try:
-      if topic:
-        tweets = topic.tweets.order(order).fetch(10)
-    except datastore_errors.NeedIndexError:
-      tweets = topic.tweets.fetch(10)
-      messages.append("""These results are unsorted because indexes are currently
-      unavailable.""")
+      try:
+        if snapshot:
+          tweets, next_cursor = read_snapshot(snapshot)
+        elif keyset or (order in TopicSnapshot.ORDERS and not cursor):
+          tweets, next_cursor = fetch_keyset(topic.tweets.order(order))
+        else:
+          tweets, next_cursor = fetch_page(topic.tweets.order(order))
+      except datastore_errors.NeedIndexError:
+        tweets, next_cursor = fetch_page(topic.tweets)
+        messages.append("""These results are unsorted because indexes are currently
+        unavailable.""")
+    except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+      self.error(400) # Bad cursor or order
+      return
+
+    next_url = None
+    if next_cursor:
+      params = [('cursor', next_cursor)]
+      if self.request.get("order"):
+        params.insert(0, ('order', order))
+      if self.request.get("limit"):
+        params.append(('limit', limit))
+      next_url = '%s?%s' % (self.request.path, urllib.urlencode(params))
+      self.response.headers['X-Next-Cursor'] = next_cursor
+      self.response.headers['Link'] = '<%s>; rel="next"' % next_url
 
     template_values = {
         'topic_name': topic_name,
@@ -50,48 +264,35 @@ class TopicDetail(webapp.RequestHandler):
         'tweets': tweets,
         'topic': topic,
         'request_path': self.request.path,
-        'new_topic': (datetime.now() - topic.created_at).seconds < 360,
+        'next_url': next_url,
+        'new_topic': datetime.now() - topic.created_at < timedelta(minutes=6),
         }
 
     def render_html(template_values):
+      # Tweets stored before markup existed
       for tweet in template_values['tweets']:
-        tweet.content = NAME_RE.sub(
-            lambda m: '<a href="http://twitter.com/%s">@%s</a>' % (m.groups() * 2),
-            tweet.content
-            )
+        if tweet.markup is None:
+          tweet.markup = tweet_markup(tweet.content)
       path = os.path.join(os.path.dirname(__file__), 'templates/show.html')
-      return template.render(path, template_values)
+      self.response.out.write(template.render(path, template_values))
 
     def render_json(template_values):
-      if template_values['topic'] is None:
-        self.error(404)
-        return
       self.response.headers['Content-Type'] = 'application/json'
-      items = []
-      for tweet in template_values['tweets']:
-        item = {}
-        items.append(item)
-        for property in tweet.properties():
-          if property in ['topics', 'influence']:
-            continue
-          if 'created_at' == property:
-            item[property] = tweet.created_at.isoformat() + 'Z'
-          else:
-            item[property] = unicode(getattr(tweet, property))
-        item['source_url'] = tweet.source_url()
-      return simplejson.dumps(items)
+      write_json(self.response.out, template_values['tweets'])
+
+    def render_ndjson(template_values):
+      self.response.headers['Content-Type'] = 'application/x-ndjson'
+      write_json(self.response.out, template_values['tweets'], lines=True)
 
     def render_xml(template_values):
-      if template_values['topic'] is None:
-        self.error(404)
-        return
       self.response.headers['Content-Type'] = 'application/rss+xml'
       path = os.path.join(os.path.dirname(__file__), 'templates/show.rss')
-      return template.render(path, template_values)
+      self.response.out.write(template.render(path, template_values))
 
     formats = {
         'html': render_html,
         'json': render_json,
+        'ndjson': render_ndjson,
         'rss': render_xml,
         }
 
@@ -99,7 +300,78 @@ class TopicDetail(webapp.RequestHandler):
       self.error(404)
       return
 
-    self.response.out.write(formats[format](template_values))
+    formats[format](template_values)
+    # Pages of new topics say so, for a few minutes.
+    if not template_values['new_topic']:
+      headers = {}
+      for name in CACHED_HEADERS:
+        if self.response.headers.get(name):
+          headers[name] = self.response.headers[name]
+      memcache.set(page_key, {
+          'generation': generation,
+          'headers': headers,
+          'body': self.response.out.getvalue(),
+          }, PAGE_CACHE_TIME)
+
+  def validate(self, etag, modified):
+    """Sets the validators of the response, and checks the request's
+    If-None-Match or If-Modified-Since header against them.
+
+    Parameters
+      etag: The ETag of the response.
+      modified: When the response last changed, in seconds since the epoch.
+    Returns
+      True if the client's copy is current.
+    """
+    self.response.headers['ETag'] = etag
+    self.response.headers['Last-Modified'] = \
+        email.utils.formatdate(modified, usegmt=True)
+
+    match = self.request.headers.get('If-None-Match')
+    if match:
+      tags = [tag.strip() for tag in match.split(',')]
+      return etag in tags or '*' in tags
+    since = self.request.headers.get('If-Modified-Since')
+    if since:
+      since = email.utils.parsedate_tz(since)
+      return since is not None and \
+          int(modified) <= email.utils.mktime_tz(since)
+    return False
+
+class Trending(webapp.RequestHandler):
+  """Handles the lists of trending topics found by the rank and bursts
+  tasks.
+  """
+
+  def get(self, format='html'):
+    """Retrieve the topics bursting this hour, and the topics trending over
+    the last week.
+    """
+    lists = memcache.get_multi(['bursts', 'trending'])
+    bursts = [
+        {'name': name, 'score': score, 'count': count}
+        for score, name, key, count in lists.get('bursts', [])
+        ]
+    trending = [
+        {'name': name, 'rank': rank}
+        for rank, name, key in lists.get('trending', [])
+        ]
+
+    if format == 'json':
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.out.write(
+          simplejson.dumps({'bursts': bursts, 'trending': trending})
+          )
+    elif format == 'html':
+      template_values = {
+          'title': 'Trending',
+          'bursts': bursts,
+          'trending': trending,
+          }
+      path = os.path.join(os.path.dirname(__file__), 'templates/trending.html')
+      self.response.out.write(template.render(path, template_values))
+    else:
+      self.error(404)
 
 class TopicIndex(webapp.RequestHandler):
   """Handles request to create topics."""
@@ -123,6 +395,9 @@ class TopicIndex(webapp.RequestHandler):
 
     topics = Topic.from_tokens(tokens)
     db.save(topics)
+    TopicMatcher.add_topic(tokens)
+    Topic.add_to_bloom(topics)
+    Topic.record_length(len(tokens))
 
     self.redirect('/topics/%s' % urllib.quote(topic_name.encode('utf8')))
 
@@ -170,15 +445,40 @@ class SettingsHandler(webapp.RequestHandler):
         key_name='key:' + name,
         value=self.request.get('value')
         ).put()
+    Settings.flush(name)
     if setting:
-      logging.info("Setting %s changed.")
+      logging.info("Setting %s changed." % name)
+      self.redirect(self.request.path)
+
+class FetchListHandler(webapp.RequestHandler):
+  """Handles requests to set the timelines downloaded by Fetch."""
+
+  def get(self):
+    """Displays a form listing the URLs, one per line."""
+    urls = FetchList.get_urls([])
+    self.response.out.write("""<html><body>
+        <form action="%s" method="POST">
+          fetch_urls:<br>
+          <textarea name="urls" rows="10" cols="80">%s</textarea><br>
+          <input type="submit" value="Update">
+        </form>
+      </body>
+    </html>""" % (self.request.path, cgi.escape('\n'.join(urls))))
+
+  def post(self):
+    """Records the URLs, separated by whitespace."""
+    if FetchList.set_urls(self.request.get('urls').split()):
+      logging.info("Fetch list changed.")
       self.redirect(self.request.path)
 
 application = webapp.WSGIApplication([
   ('/', Main),
   ('/topics/', TopicIndex),
+  ('/trending\.(\w+)', Trending),
+  ('/trending', Trending),
   ('/topics/(.+)\.(\w+)', TopicDetail),
   ('/topics/(.+)', TopicDetail),
+  ('/settings/fetch_urls', FetchListHandler),
   ('/settings/(\w+)', SettingsHandler),
 ], debug=True)
 
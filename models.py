@@ -4,35 +4,105 @@
 
 from google.appengine.ext import db
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from django.utils.html import urlize
 
 from datetime import datetime, timedelta
+from array import array
+
+from bloom import BloomFilter, SHARD_SIZE
 
 import pickle
+import random
 from pickle import UnpicklingError
 
 import re
 import operator
 import math
 import logging
+import struct
+import sys
+import time
+import zlib
 
 DAY_SCALE = 4
 LOCAL_EPOCH = datetime(2009, 7, 12)
 
 URL_RE = re.compile(u"""http://\S+""", re.UNICODE)
 SPLIT_RE = re.compile(u"""[\s.,"\u2026\u3001\u3002?]+""", re.UNICODE)
+NAME_RE = re.compile("@(\w+)")
 
 MAX_ACTIVITY = 0x10ffff
+# Number of values in an activity series, including two of metadata.
+SERIES_LENGTH = 60
+TOPIC_BLOOM = 'topic-bloom'
+TOPIC_BLOOM_LOCK = 'topic-bloom-lock'
+# Number of hourly buckets of activity kept for detecting bursts.
+BURST_HOURS = 48
+# Tweets kept in a TopicSnapshot for each order, and the Tweet properties kept,
+# in the order they are encoded.
+SNAPSHOT_SIZE = 20
+SNAPSHOT_FIELDS = (
+    'source_id', 'content', 'created_at', 'pic_url', 'author', 'influence',
+    'markup',
+    )
+
+BATCH_VERSION = 1
+BATCH_HEADER = struct.Struct('!QII')
+BATCH_LENGTH = struct.Struct('!H')
+BATCH_CHUNK = 4096
+
+# Recently processed tweet IDs are kept in memcache, in one bucket for each
+# SEEN_BUCKET seconds, for SEEN_BUCKETS buckets.
+SEEN_BUCKET = 60
+SEEN_BUCKETS = 10
+# Seconds a lock on the topic matcher or bloom filter is held while one
+# changes, so concurrent changes don't overwrite each other.
+SAVE_LOCK_TIME = 30
+# Values of a setting which is on. See Settings.get_flag.
+FLAG_VALUES = ('1', 'true', 'yes', 'on')
 
 class Batch(db.Model):
   """Represents the JSON string from the Twitter public timeline.
 
   Properties
-    pickled_items: Pickled JSON from the public timeline.
+    pickled_items: Pickled JSON from the public timeline. Only found in
+      Batches stored before encoded_items.
+    encoded_items: The items from the public timeline, encoded with
+      encode_items.
+    progress: Number of records from Tweet.from_batch already processed.
     created_at: Timestamp for this batch.
   """
   pickled_items = db.BlobProperty()
+  encoded_items = db.BlobProperty()
+  progress = db.IntegerProperty(default=0)
   created_at = db.DateTimeProperty(auto_now_add=True)
 
+  def from_items(items):
+    """Builds a Batch from the items in the public timeline.
+
+    Parameters
+      items: List of items decoded from the public timeline JSON.
+    Returns
+      The Batch.
+    """
+    return Batch(encoded_items=encode_items(items))
+  from_items = staticmethod(from_items)
+
+  def iter_items(self):
+    """Yields the items in the Batch, one at a time.
+
+    Returns
+      An iterator of items, with the fields kept by encode_items.
+    """
+    if self.encoded_items is not None:
+      return decode_items(self.encoded_items)
+    try:
+      return iter(pickle.loads(self.pickled_items))
+    except UnpicklingError:
+      logging.error("Could not unpickle Batch %d" % self.key().id())
+      return iter([])
+
 class Tweet(db.Model):
   """Represents a Tweet.
 
@@ -44,6 +114,8 @@ class Tweet(db.Model):
     topics: Topics associated with this Tweet.
     influence: A calculated score based on the number of followers and when
       the Tweet was added.
+    markup: The content as HTML, with mentions and URLs linked. See
+      tweet_markup.
   """
   content = db.StringProperty(multiline=True)
   created_at = db.DateTimeProperty()
@@ -52,6 +124,7 @@ class Tweet(db.Model):
   source_id = db.StringProperty()
   topics = db.ListProperty(db.Key)
   influence = db.StringProperty()
+  markup = db.TextProperty()
 
   def source_url(self):
     """Returns the URL of the Tweet.
@@ -62,47 +135,146 @@ class Tweet(db.Model):
     return "http://twitter.com/%s/statuses/%s" % (self.author, self.source_id)
 
   def from_batch(batch):
-    """Return a list of Tweets from a Batch.
+    """Return a list of TweetRecords from a Batch.
 
     Parameters
       batch: A Batch object.
     Returns
-      A list of Tweets converted from items in the Batch.
+      A list of TweetRecords converted from items in the Batch.
     """
-    try:
-      feed = pickle.loads(batch.pickled_items)
-    except UnpicklingError:
-      logging.error("Could not unpickle Batch %d" % batch.key().id())
+    return Tweet.from_items(batch.iter_items())
+  from_batch = staticmethod(from_batch)
+
+  def from_items(items):
+    """Return a list of TweetRecords from items in the public timeline.
 
+    Parameters
+      items: Items decoded from the public timeline JSON.
+    Returns
+      A list of TweetRecords.
+    """
     tweets = []
-    for item in feed:
+    for item in items:
       if item['user']['followers_count'] == 0 or \
          item['user']['friends_count'] == 0:
         continue
-      try:
-        tweet = Tweet(
-            key_name="tweet:%d" % (item['id']),
-            content=item['text'],
-            created_at=parse_created_at(item['created_at']),
-            pic_url=item['user']['profile_image_url'],
-            author=item['user']['screen_name'],
-            source_id=str(item['id']),
-            topics=[]
-            )
-        days = (tweet.created_at - LOCAL_EPOCH).days
-        influence_factor = max(1, item['user']['followers_count'])
-        tweet.influence = "%020d|%s" % (
-            long(days * DAY_SCALE + math.log(influence_factor)),
-            tweet.source_id
-            )
-        tweets.append(tweet)
-      except datastore_errors.BadValueError, e:
-        logging.error("Error saving tweet %d from %s: %s." %
-            (item['id'], item['user']['screen_name'], e.message)
-            )
+      tweets.append(TweetRecord(item))
 
     return tweets
-  from_batch = staticmethod(from_batch)
+  from_items = staticmethod(from_items)
+
+class TweetRecord(object):
+  """A tweet from the public timeline which has not been matched to topics.
+
+  Most tweets are not about any topic, so a TweetRecord only carries what is
+  needed to match it. A Tweet is built from it with to_tweet, once it is known
+  to be on topic.
+
+  Properties
+    id: Tweet ID in Twitter.
+    content: Text content of the tweet.
+    tokens: The content, tokenized.
+    topics: Topics associated with this tweet.
+    item: The item from the public timeline.
+  """
+  __slots__ = ('id', 'content', 'tokens', 'topics', 'item')
+
+  def __init__(self, item):
+    self.id = item['id']
+    self.content = item['text']
+    self.tokens = Topic.tokenize(self.content)
+    self.topics = []
+    self.item = item
+
+  def to_tweet(self):
+    """Builds the Tweet.
+
+    Returns
+      The Tweet, or None if the item from the public timeline is not valid.
+    """
+    item = self.item
+    try:
+      tweet = Tweet(
+          key_name="tweet:%d" % (item['id']),
+          content=item['text'],
+          created_at=parse_created_at(item['created_at']),
+          pic_url=item['user']['profile_image_url'],
+          author=item['user']['screen_name'],
+          source_id=str(item['id']),
+          topics=self.topics,
+          markup=tweet_markup(item['text'])
+          )
+      days = (tweet.created_at - LOCAL_EPOCH).days
+      influence_factor = max(1, item['user']['followers_count'])
+      tweet.influence = "%020d|%s" % (
+          long(days * DAY_SCALE + math.log(influence_factor)),
+          tweet.source_id
+          )
+      return tweet
+    except datastore_errors.BadValueError, e:
+      logging.error("Error saving tweet %d from %s: %s." %
+          (item['id'], item['user']['screen_name'], e.message)
+          )
+
+  def seen_keys(_now=None):
+    """Returns the memcache keys of the buckets of recently seen tweet IDs,
+    newest first.
+    """
+    bucket = int((_now or time.time()) / SEEN_BUCKET)
+    return ['seen:%d' % (bucket - age) for age in range(SEEN_BUCKETS)]
+  seen_keys = staticmethod(seen_keys)
+
+  def drop_seen(records):
+    """Removes TweetRecords which were processed recently, or which are
+    repeated. Consecutive fetches of the public timeline overlap.
+
+    Parameters
+      records: A list of TweetRecords.
+    Returns
+      A list of the TweetRecords which were not seen.
+    """
+    seen = set()
+    for ids in memcache.get_multi(TweetRecord.seen_keys()).values():
+      seen.update(ids)
+    unseen = []
+    for record in records:
+      if record.id not in seen:
+        seen.add(record.id)
+        unseen.append(record)
+    return unseen
+  drop_seen = staticmethod(drop_seen)
+
+  def remember(records):
+    """Remembers that TweetRecords were processed. See drop_seen.
+
+    Parameters
+      records: A list of TweetRecords.
+    """
+    key = TweetRecord.seen_keys()[0]
+    ids = memcache.get(key) or set()
+    ids.update([record.id for record in records])
+    memcache.set(key, ids, time=SEEN_BUCKET * (SEEN_BUCKETS + 1))
+  remember = staticmethod(remember)
+
+class SeriesProperty(db.BlobProperty):
+  """Stores the activity series of a Topic. See Topic.series."""
+
+  def get_value_for_datastore(self, model_instance):
+    if model_instance._series is not None:
+      return db.Blob(series_to_blob(model_instance._series))
+    return super(SeriesProperty, self).get_value_for_datastore(model_instance)
+
+class ActivityStringProperty(db.StringProperty):
+  """Stores the activity series of a Topic encoded as a string, so that Topics
+  can be sorted by activity. See Topic.set_activity.
+  """
+
+  def get_value_for_datastore(self, model_instance):
+    if model_instance._series is not None:
+      return u''.join([int_to_uni(number) for number in model_instance._series])
+    return super(ActivityStringProperty, self).get_value_for_datastore(
+        model_instance
+        )
 
 class Topic(db.Model):
   """A Topic which users can introduce to e-drop, and which Tweets can be
@@ -113,15 +285,29 @@ class Topic(db.Model):
     created_at: When the topic was created.
     creator: The User who created the topic. Can be None.
     score: A ranking property, yet unused.
-    activity: Can be decoded to determine how active a topic is.
+    activity: Can be decoded to determine how active a topic is. Encoded
+      from activity_series when stored.
+    activity_series: The activity series as an array of numbers.
     weekly_rank: A ranking based on activity in the last week.
+    hourly: The number of tweets in each of the last BURST_HOURS hours. See
+      record_hourly.
+    hourly_at: The newest hour counted in hourly, in hours since the local
+      epoch.
   """
   name = db.StringProperty()
   created_at = db.DateTimeProperty(auto_now_add=True)
   creator = db.UserProperty()
   score = db.IntegerProperty(default=0)
-  activity = db.StringProperty(default=60 * '\x00', multiline=True)
+  activity = ActivityStringProperty(
+      default=SERIES_LENGTH * '\x00', multiline=True
+      )
+  activity_series = SeriesProperty()
   weekly_rank = db.StringProperty()
+  hourly = db.BlobProperty()
+  hourly_at = db.IntegerProperty()
+
+  # The decoded activity series. See series.
+  _series = None
 
   @property
   def tweets(self):
@@ -132,7 +318,7 @@ class Topic(db.Model):
     """
     return Tweet.all().filter("topics =", self.key())
 
-  def create_path(tokens):
+  def create_path(tokens, leaf=True):
     """Static method which creates a tuple representing the path from a root
     topic to a leaf. For example, the multiword topic "hello world", when
     converted to a path, becomes a tree with a root "hello" and child "world".
@@ -140,11 +326,13 @@ class Topic(db.Model):
 
     Parameters
       tokens: List of words in the topic. Can be just one word.
+      leaf: If False, the path is to the ancestor which begins longer topics,
+        rather than to the topic itself.
     Returns
       A tuple representing the path.
     """
     parentcount = len(tokens) - 1
-    prefixes = parentcount * ('parent:',) + ('key:',)
+    prefixes = parentcount * ('parent:',) + (leaf and 'key:' or 'parent:',)
     keynames = map(operator.add, prefixes, tokens)
     return sum(zip(len(tokens) * ('Topic',), keynames), ())
   create_path = staticmethod(create_path)
@@ -197,62 +385,380 @@ class Topic(db.Model):
     return words + urls
   tokenize = staticmethod(tokenize)
 
-  def link_topics(tweets):
+  def tokenize_tweet(tweet):
+    """Tokenizes the content of a Tweet or TweetRecord.
+
+    Parameters
+      tweet: A Tweet or TweetRecord.
+    Returns
+      List of words.
+    """
+    if isinstance(tweet, TweetRecord):
+      return tweet.tokens
+    return Topic.tokenize(tweet.content)
+  tokenize_tweet = staticmethod(tokenize_tweet)
+
+  def path_tokens(key):
+    """Static method which is the inverse of create_path. It recovers the words
+    of a topic from the key of its leaf.
+
+    Parameters
+      key: Key of a Topic.
+    Returns
+      A list of words.
+    """
+    keynames = key.to_path()[1::2]
+    return [keyname.split(':', 1)[1] for keyname in keynames]
+  path_tokens = staticmethod(path_tokens)
+
+  def link_topics(tweets, matcher=None, frontier=False, stats=None,
+                  bloom=None):
+    """Associates Tweets with the Topics they contain.
+
+    Parameters
+      tweets: A Tweet or a list of Tweets.
+      matcher: A TopicMatcher. When given, topics are matched in memory instead
+        of querying the datastore.
+      frontier: If True, multiword topics are found one word at a time with
+        Topic.link_by_level instead of asking for every possible phrase.
+      stats: Optional dict. The number of keys requested from the datastore
+        in each round trip is stored as a list in stats['keys_per_level'].
+      bloom: A BloomFilter of Topic.bloom_name for every Topic. When given,
+        keys which are not in it are not requested. See Topic.get_probable.
+    Returns
+      A dict of Topics to the list of Tweets which mention them.
+    """
     if isinstance(tweets, Tweet):
       tweets = [tweets]
 
-    tweets_by_word = {}
+    if matcher is not None:
+      return matcher.link(tweets)
+
     words_in_tweet = {}
+    for tweet in tweets:
+      words_in_tweet[tweet] = Topic.tokenize_tweet(tweet)
+
+    if stats is None:
+      stats = {}
+    stats['keys_per_level'] = []
+
+    if frontier:
+      link = Topic.link_by_level
+    else:
+      link = Topic.link_by_phrase
+    tweets_per_topic = link(tweets, words_in_tweet, stats, bloom)
+
+    for topic, topic_tweets in tweets_per_topic.items():
+      for tweet in topic_tweets:
+        tweet.topics.append(topic.key())
+
+    return tweets_per_topic
+  link_topics = staticmethod(link_topics)
+
+  def link_by_phrase(tweets, words_in_tweet, stats, bloom=None):
+    """Finds Topics by asking the datastore for every phrase which begins with
+    an existing parent. See Topic.link_topics.
 
+    Parameters
+      tweets: A list of Tweets.
+      words_in_tweet: A dict of Tweets to their tokens.
+      stats: A dict to record the number of keys requested.
+      bloom: Optional BloomFilter of topics.
+    Returns
+      A dict of Topics to the list of Tweets which mention them.
+    """
+    tweets_by_word = {}
     for tweet in tweets:
-      words_in_tweet[tweet] = Topic.tokenize(tweet.content)
       for word in set(words_in_tweet[tweet]):
         if word not in tweets_by_word:
           tweets_by_word[word] = []
         tweets_by_word[word].append(tweet)
 
     words = tweets_by_word.keys()
-    parenttopics = Topic.get_by_key_name(['parent:' + word for word in words])
+    parentkeys = [
+        db.Key.from_path(*Topic.create_path([word], leaf=False))
+        for word in words
+        ]
+    parenttopics = Topic.get_probable(parentkeys, stats, bloom)
     begins_a_phrase = dict(zip(words, parenttopics))
-    keys = []
-    for word in words:
-      keys.append(db.Key.from_path(*Topic.create_path([word])))
-
-      if not begins_a_phrase[word]:
-        continue
+    keys = [db.Key.from_path(*Topic.create_path([word])) for word in words]
 
-      memo = {}
-      tweets = tweets_by_word[word]
-      for tweet in tweets:
-        tokens = words_in_tweet[tweet]
-        while word in tokens:
-          start = tokens.index(word)
-          slice = tokens[start:]
-          for index in range(len(slice)):
-            if index == 0:
-              continue
-            pieces = slice[:index + 1]
-            path = Topic.create_path(pieces)
+    # Build a key for every phrase which starts with a parent, but never one
+    # longer than the longest topic.
+    maxlength = Topic.max_length()
+    tweets_by_phrase = {}
+    for tweet in tweets:
+      tokens = words_in_tweet[tweet]
+      for start, word in enumerate(tokens):
+        if not begins_a_phrase[word]:
+          continue
+        stop = len(tokens)
+        if maxlength:
+          stop = min(stop, start + maxlength)
+        for end in xrange(start + 2, stop + 1):
+          topic_name = ' '.join(tokens[start:end])
+          phrase_tweets = tweets_by_phrase.get(topic_name)
+          if phrase_tweets is None:
+            phrase_tweets = tweets_by_phrase[topic_name] = []
+            path = Topic.create_path(tokens[start:end])
             keys.append(db.Key.from_path(*path))
+          if not phrase_tweets or phrase_tweets[-1] is not tweet:
+            phrase_tweets.append(tweet)
+
+    tweets_by_word.update(tweets_by_phrase)
+    tweets_per_topic = {}
+    topics = Topic.get_probable(keys, stats, bloom)
+    topics = [topic for topic in topics if topic]
+    for topic in topics:
+      tweets_per_topic[topic] = tweets_by_word[topic.name]
 
-            topic_name = ' '.join(pieces)
+    return tweets_per_topic
+  link_by_phrase = staticmethod(link_by_phrase)
 
-            if topic_name not in memo:
-              memo[topic_name] = []
-            memo[topic_name].append(tweet)
-          tokens = tokens[start + 1:]
+  def link_by_level(tweets, words_in_tweet, stats, bloom=None):
+    """Finds Topics breadth first, one word at a time. See Topic.link_topics.
 
-        tweets_by_word.update(memo)
+    The first round trip asks for the parent and the topic of every word.
+    Each following round trip only asks for the children of the parents found
+    in the previous one, so "encino my" is never requested unless the parent
+    "encino" has a child "my". There are as many round trips as words in the
+    longest topic found.
+
+    Parameters
+      tweets: A list of Tweets.
+      words_in_tweet: A dict of Tweets to their tokens.
+      stats: A dict to record the number of keys requested.
+      bloom: Optional BloomFilter of topics.
+    Returns
+      A dict of Topics to the list of Tweets which mention them.
+    """
+    # Maps each phrase to where it occurs, as pairs of Tweet and the index of
+    # the last word of the phrase.
+    frontier = {}
+    for tweet in tweets:
+      for index, word in enumerate(words_in_tweet[tweet]):
+        frontier.setdefault((word,), []).append((tweet, index))
 
     tweets_per_topic = {}
-    topics = [topic for topic in Topic.get(keys) if topic]
-    for topic in topics:
-      tweets_per_topic[topic] = tweets_by_word[topic.name]
-      for tweet in tweets_per_topic[topic]:
-        tweet.topics.append(topic.key())
+    while frontier:
+      phrases = frontier.keys()
+      keys = []
+      for phrase in phrases:
+        keys.append(db.Key.from_path(*Topic.create_path(phrase, leaf=False)))
+        keys.append(db.Key.from_path(*Topic.create_path(phrase)))
+      found = Topic.get_probable(keys, stats, bloom)
+
+      children = {}
+      for index, phrase in enumerate(phrases):
+        parent, topic = found[2 * index], found[2 * index + 1]
+        occurrences = frontier[phrase]
+        if topic:
+          topic_tweets = tweets_per_topic[topic] = []
+          for tweet, end in occurrences:
+            if not topic_tweets or topic_tweets[-1] is not tweet:
+              topic_tweets.append(tweet)
+        if parent:
+          for tweet, end in occurrences:
+            tokens = words_in_tweet[tweet]
+            if end + 1 < len(tokens):
+              child = phrase + (tokens[end + 1],)
+              children.setdefault(child, []).append((tweet, end + 1))
+      frontier = children
 
     return tweets_per_topic
-  link_topics = staticmethod(link_topics)
+  link_by_level = staticmethod(link_by_level)
+
+  def get_probable(keys, stats, bloom=None):
+    """Gets Topics by key, skipping keys which are not in a BloomFilter.
+
+    The number of keys requested is appended to stats['keys_per_level']. The
+    number of keys skipped, and the number requested but not found although
+    they were in the filter, are added to stats['bloom_skipped'] and
+    stats['bloom_false_positives'].
+
+    Parameters
+      keys: List of keys.
+      stats: A dict to record the number of keys requested.
+      bloom: Optional BloomFilter of topics.
+    Returns
+      A list of Topics or None, in the same order as keys.
+    """
+    if bloom is None:
+      stats['keys_per_level'].append(len(keys))
+      return Topic.get(keys)
+
+    probable = [key for key in keys if Topic.bloom_name(key) in bloom]
+    stats['keys_per_level'].append(len(probable))
+    found = dict(zip(probable, Topic.get(probable)))
+    stats['bloom_skipped'] = \
+        stats.get('bloom_skipped', 0) + len(keys) - len(probable)
+    stats['bloom_false_positives'] = \
+        stats.get('bloom_false_positives', 0) + found.values().count(None)
+    return [found.get(key) for key in keys]
+  get_probable = staticmethod(get_probable)
+
+  def bloom_name(key):
+    """Returns the name by which a Topic is known in the BloomFilter of
+    topics: the key names along its path, e.g. "parent:encino/key:man".
+
+    Parameters
+      key: Key of a Topic.
+    Returns
+      A string.
+    """
+    return '/'.join(key.to_path()[1::2])
+  bloom_name = staticmethod(bloom_name)
+
+  def build_bloom(batchsize=1000):
+    """Builds a BloomFilter of every Topic in the datastore, and stores it in
+    memcache.
+
+    The filter is stored while holding TOPIC_BLOOM_LOCK, like add_to_bloom.
+    Topics created since the build started may only be in the filter it
+    replaces, so they are added and the filter is stored again, until none
+    are missing.
+
+    Parameters
+      batchsize: Number of keys to fetch at a time.
+    Returns
+      The BloomFilter.
+    """
+    # Topics are created with the clock of another server.
+    started = datetime.now() - timedelta(minutes=1)
+    names = []
+    longest = 0
+    query = Topic.all(keys_only=True)
+    keys = query.fetch(batchsize)
+    while keys:
+      names.extend([Topic.bloom_name(key) for key in keys])
+      for key in keys:
+        if key.name().startswith('key:'):
+          longest = max(longest, len(key.to_path()) / 2)
+      query.with_cursor(query.cursor())
+      keys = query.fetch(batchsize)
+    Topic.record_length(longest, scanned=True)
+
+    # Leave room for the topics added before the next rebuild.
+    bloom = BloomFilter.with_capacity(2 * len(names) + 1000)
+    for name in names:
+      bloom.add(name)
+
+    if not memcache.add(TOPIC_BLOOM_LOCK, True, SAVE_LOCK_TIME):
+      logging.warning("Topics are being added, not storing the bloom filter.")
+      return bloom
+    try:
+      while bloom.save(TOPIC_BLOOM):
+        names = [Topic.bloom_name(key) for key in Topic.created_since(started)]
+        names = [name for name in names if name not in bloom]
+        if not names:
+          return bloom
+        for name in names:
+          bloom.add(name)
+      logging.error("Could not store the topic bloom filter in memcache.")
+      return bloom
+    finally:
+      memcache.delete(TOPIC_BLOOM_LOCK)
+  build_bloom = staticmethod(build_bloom)
+
+  def add_to_bloom(topics):
+    """Adds new Topics to the BloomFilter of topics, if there is one.
+
+    A filter missing a Topic would skip it, so when another task is changing
+    the filter, or it can't be stored, it is dropped instead, and Topics are
+    looked up without it until it is built again.
+
+    Parameters
+      topics: A list of Topics, e.g. from Topic.from_tokens.
+    """
+    if not memcache.add(TOPIC_BLOOM_LOCK, True, SAVE_LOCK_TIME):
+      memcache.delete(TOPIC_BLOOM)
+      return
+    try:
+      bloom = BloomFilter.load(TOPIC_BLOOM)
+      if bloom is not None:
+        changed = set()
+        for topic in topics:
+          changed.update(bloom.add(Topic.bloom_name(topic.key())))
+        if not bloom.save(TOPIC_BLOOM, changed):
+          memcache.delete(TOPIC_BLOOM)
+    finally:
+      memcache.delete(TOPIC_BLOOM_LOCK)
+  add_to_bloom = staticmethod(add_to_bloom)
+
+  def created_since(since, batchsize=1000):
+    """Returns the keys of the Topics created since a date.
+
+    Parameters
+      since: The date. Clocks of different servers differ, so it should be a
+        little before the date wanted.
+      batchsize: Number of keys to fetch at a time.
+    Returns
+      A list of keys.
+    """
+    found = []
+    query = Topic.all(keys_only=True).filter('created_at >=', since)
+    keys = query.fetch(batchsize)
+    while keys:
+      found.extend(keys)
+      query.with_cursor(query.cursor())
+      keys = query.fetch(batchsize)
+    return found
+  created_since = staticmethod(created_since)
+
+  def max_length():
+    """Returns the number of words in the longest topic.
+
+    Returns
+      The number of words, or None if it is not known.
+    """
+    return int(Settings.get_value('longest_topic', 0)) or None
+  max_length = staticmethod(max_length)
+
+  def record_length(length, scanned=False):
+    """Records the number of words in a topic, if it is the longest topic.
+
+    The length is only known once every Topic has been scanned, by
+    build_bloom or CompileMatcher. Until then, lengths of new topics are not
+    recorded, so that a short new topic doesn't hide longer existing ones.
+
+    Parameters
+      length: The number of words in the topic.
+      scanned: Whether length is of the longest of every Topic.
+    """
+    def longest():
+      setting = Settings.get_by_key_name('key:longest_topic')
+      if setting is None and not scanned:
+        return
+      if not setting or int(setting.value) < length:
+        Settings(key_name='key:longest_topic', value=str(length)).put()
+    db.run_in_transaction(longest)
+    Settings.flush('longest_topic')
+  record_length = staticmethod(record_length)
+
+  def series(self):
+    """Returns the activity series of the topic, decoding it only once.
+
+    The series is an array of SERIES_LENGTH numbers laid out like the activity
+    string described in set_activity. Topics stored before activity_series
+    existed are decoded from the activity string.
+
+    Returns
+      An array.
+    """
+    if self._series is None:
+      self._series = self.decode_series()
+    return self._series
+
+  def decode_series(self):
+    """Decodes the activity series of the topic, without keeping it. Unlike
+    series, changes to the array are not stored with the Topic.
+
+    Returns
+      An array.
+    """
+    if self.activity_series:
+      return blob_to_series(self.activity_series)
+    return array('I', [uni_to_int(char) for char in self.activity])
 
   def record_activity(self, score, batchsize=20, _now=datetime.now()):
     """Records activity for a topic based on the number of tweets in a batch.
@@ -265,29 +771,53 @@ class Topic(db.Model):
     if score > batchsize:
       raise ValueError("%d cannot be > batchsize %d" % (score, batchsize))
 
+    series = self.series()
     share = (self.get_activity(_now=_now) or 0) / MAX_ACTIVITY
-    size = uni_to_int(self.activity[1])
+    size = series[1]
 
     count = share * size
     newsize = size + batchsize
     newshare = (count + score) / float(newsize)
-    self.activity = self.activity[:1] + int_to_uni(newsize) + self.activity[2:]
+    if newsize > MAX_ACTIVITY:
+      raise OverflowError("%s not in range [0, %s]" % (newsize, MAX_ACTIVITY))
+    series[1] = newsize
 
     self.set_activity(int(newshare * MAX_ACTIVITY), _now=_now)
-    activities = [
-        self.get_activity(_now=_now - timedelta(offset)) or 0
-        for offset
-        in range(7, 0, -1)
-        ]
-    changes = map(
-        lambda p, q: 0 if p == 0 else float(q) / p,
-        activities[:-1],
-        activities[1:]
-        )
-    days = (_now - LOCAL_EPOCH).days
-    self.weekly_rank = "%20f" % (
-        days * DAY_SCALE + sum(changes) / float(len(changes))
-        )
+    self.weekly_rank = rank_series([series], _now)[0]
+
+  def hourly_ring(self):
+    """Decodes the hourly activity of the topic. See record_hourly.
+
+    Returns
+      An array of BURST_HOURS numbers.
+    """
+    if self.hourly:
+      return blob_to_series(self.hourly)
+    return array('I', [0]) * BURST_HOURS
+
+  def record_hourly(self, count, _now=None):
+    """Adds tweets to the hourly activity of the topic, which is used to
+    detect bursts within a day. See burst_scores.
+
+    The counts are kept in a ring of BURST_HOURS numbers, where the count of an
+    hour is at the number of hours since the local epoch modulo BURST_HOURS.
+    Buckets between hourly_at and a newer hour are cleared before counting.
+
+    Parameters
+      count: The number of tweets associated with this topic.
+      _now: When the tweets were associated.
+    """
+    hour = epoch_hours(_now or datetime.utcnow())
+    latest = self.hourly_at or 0
+    if hour <= latest - BURST_HOURS:
+      return # Older than the ring
+
+    ring = self.hourly_ring()
+    for past in range(max(latest + 1, hour - BURST_HOURS + 1), hour + 1):
+      ring[past % BURST_HOURS] = 0
+    ring[hour % BURST_HOURS] += count
+    self.hourly = db.Blob(series_to_blob(ring))
+    self.hourly_at = max(hour, latest)
 
   def get_activity(self, _now=datetime.now()):
     """Returns the activity of a topic.
@@ -295,13 +825,12 @@ class Topic(db.Model):
     Returns
       The activity value.
       """
-    # First two chars are metadata
-    meta, payload = self.activity[:2], self.activity[2:]
-    offset = uni_to_int(meta[0])
-    index = (_now - LOCAL_EPOCH).days - offset
+    # First two numbers are metadata
+    series = self.series()
+    index = (_now - LOCAL_EPOCH).days - series[0]
 
-    if 0 <= index < len(payload):
-      return uni_to_int(payload[len(payload) - index - 1])
+    if 0 <= index < len(series) - 2:
+      return series[len(series) - index - 1]
 
   def set_activity(self, activity, _now=datetime.now()):
     """Set the activity of a topic, optionally specifying a date.
@@ -319,6 +848,10 @@ class Topic(db.Model):
     determine the index position of the activity for any day after epoch +
     timedelta(60).
 
+    The same series is kept in activity_series as an array of fixed width
+    numbers, which is what is read and written. The activity string is only
+    encoded from it when the Topic is stored, so it can still be sorted on.
+
     Because the sample length is fixed, when the newest data overwrites the
     oldest data. Think of a fixed-length linked list instead of a circular
     buffer, or imagine a window sliding left over a series of samples.
@@ -329,26 +862,678 @@ class Topic(db.Model):
     Returns
       None
     """
-    # First two chars are metadata
-    meta, payload = self.activity[:2], self.activity[2:]
-    offset = uni_to_int(meta[0])
-    index = (_now - LOCAL_EPOCH).days - offset
+    if not (0 <= activity <= MAX_ACTIVITY):
+      raise OverflowError("%s not in range [0, %s]" % (activity, MAX_ACTIVITY))
+
+    # First two numbers are metadata
+    series = self.series()
+    payload = len(series) - 2
+    index = (_now - LOCAL_EPOCH).days - series[0]
 
     if index < 0: # This case is only possible in testing.
       raise ValueError("Can only store values after offset, not before.")
-    elif 0 <= index < len(payload):
-      index = len(payload) - index - 1
-      payload = payload[:index] + int_to_uni(activity) + payload[index + 1:]
+    elif 0 <= index < payload:
+      series[len(series) - index - 1] = activity
     else:
       # Zero index array needs to be one bigger than last index.
-      grow = 1 + index - len(payload)
-      meta = int_to_uni(offset + grow) + meta[1:]
+      grow = 1 + index - payload
+      series[0] += grow
       # Truncate pad to length of the payload.
-      grow = min(grow, len(payload))
-      payload = (grow * '\x00') + payload[:-grow]
-      payload = int_to_uni(activity) + payload[1:]
+      grow = min(grow, payload)
+      series[2:] = array('I', [0]) * grow + series[2:len(series) - grow]
+      series[2] = activity
+
+class TopicMatcher(object):
+  """A trie of every topic in the datastore, used to match Tweets against
+  topics without any datastore lookups.
+
+  Each topic is stored as its sequence of words, so "encino man" is reached
+  from the root by "encino" then "man". The node for the last word is marked
+  with the key None. Matching a tweet walks the trie from every word in the
+  tweet, so the cost grows with the length of the tweet rather than with the
+  number of topics.
+
+  The compiled trie is kept in memcache, compressed and split into shards like
+  a BloomFilter, and the last one loaded is kept in _loaded. When it is
+  missing, Topic.link_topics falls back to querying the datastore.
+
+  The stored trie is only replaced while holding LOCK_KEY, see add_topic and
+  publish, so that a topic added by one task is not lost when another task
+  saves.
+  """
+  MEMCACHE_KEY = 'topic-matcher'
+  LOCK_KEY = 'topic-matcher-lock'
+
+  def __init__(self, root=None, depth=0, version=None):
+    self.root = root or {}
+    self.depth = depth
+    self.version = version
 
-    self.activity = meta + payload
+  def add(self, tokens):
+    """Adds a topic to the trie.
+
+    Parameters
+      tokens: The topic as a list of words.
+    Returns
+      True if the topic was not in the trie.
+    """
+    node = self.root
+    for token in tokens:
+      node = node.setdefault(token, {})
+    added = None not in node
+    node[None] = True
+    self.depth = max(self.depth, len(tokens))
+    return added
+
+  def match(self, tokens):
+    """Finds every topic contained in a list of words.
+
+    Parameters
+      tokens: List of words, e.g. from Topic.tokenize.
+    Returns
+      A list of tuples, one for each topic found. A topic found more than once
+      is listed more than once.
+    """
+    matches = []
+    for start in xrange(len(tokens)):
+      node = self.root
+      for end in xrange(start, len(tokens)):
+        node = node.get(tokens[end])
+        if node is None:
+          break
+        if None in node:
+          matches.append(tuple(tokens[start:end + 1]))
+    return matches
+
+  def link(self, tweets):
+    """Matches Tweets against the trie. See Topic.link_topics.
+
+    The Topics returned are not read from the datastore: they only carry the
+    key and the name of the topic.
+
+    Parameters
+      tweets: A list of Tweets.
+    Returns
+      A dict of Topics to the list of Tweets which mention them.
+    """
+    topics = {}
+    tweets_per_topic = {}
+    for tweet in tweets:
+      for tokens in set(self.match(Topic.tokenize_tweet(tweet))):
+        topic = topics.get(tokens)
+        if topic is None:
+          key = db.Key.from_path(*Topic.create_path(tokens))
+          topic = Topic(
+              key_name=key.name(),
+              parent=key.parent(),
+              name=' '.join(tokens)
+              )
+          topics[tokens] = topic
+          tweets_per_topic[topic] = []
+        tweets_per_topic[topic].append(tweet)
+        tweet.topics.append(topic.key())
+    return tweets_per_topic
+
+  def compile(batchsize=1000):
+    """Builds a TopicMatcher from every Topic in the datastore.
+
+    Parameters
+      batchsize: Number of keys to fetch at a time.
+    Returns
+      The TopicMatcher.
+    """
+    matcher = TopicMatcher()
+    query = Topic.all(keys_only=True)
+    keys = query.fetch(batchsize)
+    while keys:
+      for key in keys:
+        if key.name().startswith('key:'):
+          matcher.add(Topic.path_tokens(key))
+      query.with_cursor(query.cursor())
+      keys = query.fetch(batchsize)
+    return matcher
+  compile = staticmethod(compile)
+
+  def load():
+    """Returns the compiled TopicMatcher from memcache, or None. The shards
+    are only read and decoded when the version stored is not the one loaded
+    last.
+    """
+    global _loaded
+    meta = memcache.get(TopicMatcher.MEMCACHE_KEY)
+    # Matchers stored before they were sharded are not a dict.
+    if not isinstance(meta, dict):
+      return None
+    if _loaded is not None and _loaded.version == meta['version']:
+      return _loaded
+
+    keys = ['%s:%d' % (meta['version'], shard)
+            for shard in range(meta['shards'])]
+    values = memcache.get_multi(
+        keys, key_prefix=TopicMatcher.MEMCACHE_KEY + ':'
+        )
+    if len(values) < len(keys):
+      return None
+    root = pickle.loads(zlib.decompress(''.join([values[key] for key in keys])))
+    _loaded = TopicMatcher(root, meta['depth'], meta['version'])
+    return _loaded
+  load = staticmethod(load)
+
+  def save(self):
+    """Stores the TopicMatcher in memcache, as a new version.
+
+    Returns
+      True if the TopicMatcher was stored.
+    """
+    global _loaded
+    # Distinct even when saved twice in a millisecond.
+    self.version = '%d-%d' % (time.time() * 1000, random.getrandbits(32))
+    data = zlib.compress(pickle.dumps(self.root, pickle.HIGHEST_PROTOCOL))
+    values = {}
+    for start in range(0, len(data), SHARD_SIZE):
+      values['%s:%d' % (self.version, start / SHARD_SIZE)] = \
+          data[start:start + SHARD_SIZE]
+    meta = {
+        'version': self.version,
+        'depth': self.depth,
+        'shards': len(values),
+        }
+    try:
+      stored = not memcache.set_multi(
+          values, key_prefix=TopicMatcher.MEMCACHE_KEY + ':'
+          ) and memcache.set(TopicMatcher.MEMCACHE_KEY, meta)
+    except ValueError, e:
+      logging.error("Topic matcher too large for memcache: %s" % e)
+      stored = False
+    if stored:
+      _loaded = self
+    else:
+      logging.error("Could not store the topic matcher in memcache.")
+    return stored
+
+  def publish(self, since):
+    """Stores a newly compiled TopicMatcher in place of the one in memcache.
+    Topics created since compiling started may only be in the matcher it
+    replaces, so they are added and the matcher is stored again, until none
+    are missing.
+
+    Parameters
+      since: When compiling started. See Topic.created_since.
+    Returns
+      True if the TopicMatcher was stored.
+    """
+    if not memcache.add(TopicMatcher.LOCK_KEY, True, SAVE_LOCK_TIME):
+      logging.warning("Topics are being added, not storing the matcher.")
+      return False
+    try:
+      while self.save():
+        added = False
+        for key in Topic.created_since(since):
+          if key.name().startswith('key:'):
+            added = self.add(Topic.path_tokens(key)) or added
+        if not added:
+          return True
+      return False
+    finally:
+      memcache.delete(TopicMatcher.LOCK_KEY)
+
+  def add_topic(tokens):
+    """Adds a new topic to the compiled TopicMatcher, if there is one.
+
+    When another task is changing the matcher, or it can't be stored, it is
+    dropped instead, and Topics are matched against the datastore until it is
+    compiled again.
+
+    Parameters
+      tokens: The topic as a list of words.
+    """
+    if not memcache.add(TopicMatcher.LOCK_KEY, True, SAVE_LOCK_TIME):
+      memcache.delete(TopicMatcher.MEMCACHE_KEY)
+      return
+    try:
+      matcher = TopicMatcher.load()
+      if matcher is not None:
+        matcher.add(tokens)
+        if not matcher.save():
+          memcache.delete(TopicMatcher.MEMCACHE_KEY)
+    finally:
+      memcache.delete(TopicMatcher.LOCK_KEY)
+  add_topic = staticmethod(add_topic)
+
+# The TopicMatcher loaded last. See TopicMatcher.load.
+_loaded = None
+
+class TopicSnapshot(db.Model):
+  """The newest and the most influential Tweets of a Topic, kept up to date
+  as Tweets are linked, so that the first page of a Topic can be shown with a
+  get instead of a query. The key name is the encoded key of the Topic.
+
+  Unless the snapshot is complete, each order only holds the first Tweets of
+  the Topic in that order. A Tweet which would come after the last Tweet held
+  is not added, since Tweets which are not held might come before it.
+
+  Properties
+    recent: The newest SNAPSHOT_SIZE Tweets. See encode_tweets.
+    influential: The SNAPSHOT_SIZE Tweets of highest influence.
+    complete: Whether the snapshot holds every Tweet of the Topic.
+    oldest: When the oldest Tweet held was created, so that sweeps find the
+      snapshots holding the Tweets they delete. See prune.
+  """
+  recent = db.BlobProperty()
+  influential = db.BlobProperty()
+  complete = db.BooleanProperty(default=False)
+  oldest = db.DateTimeProperty()
+
+  # Orders a snapshot can be read in, and the property holding each.
+  ORDERS = {'-created_at': 'recent', '-influence': 'influential'}
+
+  def tweets(self, order):
+    """Returns the Tweets of the snapshot in an order.
+
+    Parameters
+      order: One of ORDERS.
+    Returns
+      A list of Tweets, which are not stored.
+    """
+    return decode_tweets(getattr(self, TopicSnapshot.ORDERS[order]))
+
+  def hold(self, order, tweets):
+    """Keeps the first SNAPSHOT_SIZE of a list of Tweets in an order. A Tweet
+    listed twice is kept as it was listed last.
+
+    Parameters
+      order: One of ORDERS.
+      tweets: A list of Tweets.
+    """
+    name = order.lstrip('-')
+    tweets = dict([(tweet.source_id, tweet) for tweet in tweets]).values()
+    tweets.sort(key=lambda tweet: getattr(tweet, name), reverse=True)
+    setattr(self, TopicSnapshot.ORDERS[order],
+            db.Blob(encode_tweets(tweets[:SNAPSHOT_SIZE])))
+
+    dates = []
+    for each in TopicSnapshot.ORDERS:
+      dates.extend([tweet.created_at for tweet in self.tweets(each)])
+    self.oldest = dates and min(dates) or None
+
+  def merge(self, tweets):
+    """Adds Tweets to the snapshot, keeping the newest and the most
+    influential. A complete snapshot stops being complete once it has more
+    than SNAPSHOT_SIZE Tweets.
+
+    Parameters
+      tweets: A list of Tweets.
+    """
+    if self.complete:
+      held = self.tweets('-created_at') + tweets
+      if len(set([tweet.source_id for tweet in held])) > SNAPSHOT_SIZE:
+        self.complete = False
+      for order in TopicSnapshot.ORDERS:
+        self.hold(order, held)
+      return
+
+    for order in TopicSnapshot.ORDERS:
+      held = self.tweets(order)
+      if held:
+        name = order.lstrip('-')
+        last = getattr(held[-1], name)
+        self.hold(order, held + [tweet for tweet in tweets
+                                 if getattr(tweet, name) > last])
+
+  def drop(self, ids):
+    """Removes Tweets from the snapshot. The Tweets left in each order are
+    still the first ones.
+
+    Parameters
+      ids: A set of Tweet IDs.
+    Returns
+      True if any Tweet was removed.
+    """
+    dropped = False
+    for order in TopicSnapshot.ORDERS:
+      held = self.tweets(order)
+      kept = [tweet for tweet in held if tweet.source_id not in ids]
+      if len(kept) < len(held):
+        self.hold(order, kept)
+        dropped = True
+    return dropped
+
+  def start(key):
+    """Builds the snapshot of a Topic from the Tweets stored for it, with a
+    query for each order. An order whose index is unavailable is left empty.
+
+    Parameters
+      key: An encoded Topic key.
+    Returns
+      The TopicSnapshot, which is not stored.
+    """
+    snapshot = TopicSnapshot(key_name=key, complete=True)
+    for order in TopicSnapshot.ORDERS:
+      query = Tweet.all().filter('topics =', db.Key(key)).order(order)
+      try:
+        tweets = query.fetch(SNAPSHOT_SIZE)
+      except datastore_errors.NeedIndexError:
+        logging.warning("Started snapshot of %s without %s." % (key, order))
+        tweets = []
+        snapshot.complete = False
+      if len(tweets) == SNAPSHOT_SIZE:
+        snapshot.complete = False
+      snapshot.hold(order, tweets)
+    return snapshot
+  start = staticmethod(start)
+
+  def update(tweets_by_topic):
+    """Adds newly linked Tweets to the snapshots of their Topics, each in a
+    transaction so that concurrent tasks don't lose each other's Tweets. A
+    snapshot which doesn't exist yet is started from the Tweets already stored
+    for its Topic, see start.
+
+    Parameters
+      tweets_by_topic: A dict of encoded Topic keys to lists of Tweets.
+    """
+    def merge(key, tweets, started=None):
+      snapshot = TopicSnapshot.get_by_key_name(key) or started
+      if snapshot is None:
+        return False
+      snapshot.merge(tweets)
+      snapshot.put()
+      return True
+
+    missing = []
+    for key, tweets in tweets_by_topic.items():
+      if not db.run_in_transaction(merge, key, tweets):
+        missing.append(key)
+    # Queries can't run in a transaction.
+    for key in missing:
+      db.run_in_transaction(
+          merge, key, tweets_by_topic[key], TopicSnapshot.start(key)
+          )
+  update = staticmethod(update)
+
+  def forget(ids_by_topic):
+    """Removes deleted Tweets from the snapshots of their Topics, each in a
+    transaction. See update.
+
+    Parameters
+      ids_by_topic: A dict of encoded Topic keys to lists of Tweet IDs.
+    """
+    def forget_ids(key, ids):
+      snapshot = TopicSnapshot.get_by_key_name(key)
+      if snapshot is not None and snapshot.drop(ids):
+        snapshot.put()
+
+    for key, ids in ids_by_topic.items():
+      db.run_in_transaction(forget_ids, key, set(ids))
+  forget = staticmethod(forget)
+
+  def prune(keys, cutoff):
+    """Removes the Tweets created before a date from snapshots, each in a
+    transaction, as sweeps delete them. A snapshot left empty is deleted, and
+    started again by the next update.
+
+    Parameters
+      keys: A list of encoded Topic keys.
+      cutoff: The date.
+    Returns
+      A list of the keys of the Topics whose snapshots changed.
+    """
+    def prune_old(key):
+      snapshot = TopicSnapshot.get_by_key_name(key)
+      if snapshot is None:
+        return False
+      ids = set()
+      for order in TopicSnapshot.ORDERS:
+        ids.update([tweet.source_id for tweet in snapshot.tweets(order)
+                    if tweet.created_at < cutoff])
+      if snapshot.drop(ids) and snapshot.oldest is not None:
+        snapshot.put()
+      elif snapshot.oldest is None:
+        snapshot.delete()
+      else:
+        return False
+      return True
+
+    return [key for key in keys if db.run_in_transaction(prune_old, key)]
+  prune = staticmethod(prune)
+
+  def discard(keys):
+    """Deletes the snapshots of Topics, so that they are started again from
+    the Tweets stored. See update.
+
+    Parameters
+      keys: A list of encoded Topic keys.
+    """
+    db.delete([db.Key.from_path('TopicSnapshot', key) for key in keys])
+  discard = staticmethod(discard)
+
+def tweet_markup(content):
+  """Renders the content of a Tweet as HTML, linking mentions to their
+  authors and URLs with urlize.
+
+  Parameters
+    content: The content of the Tweet.
+  Returns
+    A string of HTML.
+  """
+  content = NAME_RE.sub(
+      lambda m: '<a href="http://twitter.com/%s">@%s</a>' % (m.groups() * 2),
+      content
+      )
+  return urlize(content, nofollow=True)
+
+def encode_tweets(tweets):
+  """Encodes Tweets for a TopicSnapshot, as a compressed pickle of a tuple of
+  the SNAPSHOT_FIELDS of each Tweet.
+
+  Parameters
+    tweets: A list of Tweets.
+  Returns
+    A string.
+  """
+  rows = [tuple([getattr(tweet, field) for field in SNAPSHOT_FIELDS])
+          for tweet in tweets]
+  return zlib.compress(pickle.dumps(rows, 2))
+
+def decode_tweets(data):
+  """Decodes Tweets encoded with encode_tweets.
+
+  Parameters
+    data: A string from encode_tweets, or None.
+  Returns
+    A list of Tweets, which are not stored.
+  """
+  if not data:
+    return []
+  tweets = []
+  for row in pickle.loads(zlib.decompress(data)):
+    fields = dict(zip(SNAPSHOT_FIELDS, row))
+    tweets.append(Tweet(key_name='tweet:' + fields['source_id'], **fields))
+  return tweets
+
+def encode_items(items):
+  """Encodes items from the public timeline into a compressed string.
+
+  Only the fields used by Tweet.from_batch are kept. The first byte is the
+  version of the encoding, the rest is compressed with zlib. Each item is
+  encoded as a header with the id, followers_count and friends_count, followed
+  by text, created_at, profile_image_url and screen_name, each as UTF-8
+  prefixed by its length.
+
+  Parameters
+    items: List of items decoded from the public timeline JSON.
+  Returns
+    A string.
+  """
+  records = []
+  for item in items:
+    user = item['user']
+    records.append(BATCH_HEADER.pack(
+        item['id'], user['followers_count'], user['friends_count']
+        ))
+    for field in [item['text'], item['created_at'],
+                  user['profile_image_url'], user['screen_name']]:
+      field = (field or u'').encode('utf8')
+      records.append(BATCH_LENGTH.pack(len(field)))
+      records.append(field)
+  return chr(BATCH_VERSION) + zlib.compress(''.join(records))
+
+def decode_items(data):
+  """Decodes items encoded with encode_items, decompressing as they are read.
+
+  Parameters
+    data: A string from encode_items.
+  Returns
+    An iterator of items, shaped like the public timeline JSON.
+  """
+  if ord(data[0]) != BATCH_VERSION:
+    raise ValueError("Unknown batch version %d" % ord(data[0]))
+
+  decompressor = zlib.decompressobj()
+  buffer = ''
+  for start in xrange(1, len(data), BATCH_CHUNK):
+    buffer += decompressor.decompress(data[start:start + BATCH_CHUNK])
+    while True:
+      decoded = decode_item(buffer)
+      if decoded is None:
+        break
+      item, end = decoded
+      buffer = buffer[end:]
+      yield item
+
+def decode_item(buffer):
+  """Decodes the first item in a buffer. See encode_items.
+
+  Parameters
+    buffer: A string.
+  Returns
+    A tuple of the item and the length of its encoding, or None if the buffer
+    does not hold a whole item.
+  """
+  if len(buffer) < BATCH_HEADER.size:
+    return None
+  id, followers_count, friends_count = BATCH_HEADER.unpack_from(buffer)
+  fields = []
+  end = BATCH_HEADER.size
+  for index in range(4):
+    if len(buffer) < end + BATCH_LENGTH.size:
+      return None
+    length, = BATCH_LENGTH.unpack_from(buffer, end)
+    end += BATCH_LENGTH.size + length
+    if len(buffer) < end:
+      return None
+    fields.append(buffer[end - length:end].decode('utf8'))
+
+  text, created_at, profile_image_url, screen_name = fields
+  item = {
+      'id': id,
+      'text': text,
+      'created_at': created_at,
+      'user': {
+        'followers_count': followers_count,
+        'friends_count': friends_count,
+        'profile_image_url': profile_image_url or None,
+        'screen_name': screen_name,
+        },
+      }
+  return item, end
+
+def rank_series(rows, _now):
+  """Calculates the weekly rank of many activity series at once.
+
+  The rank is the number of days since the local epoch, scaled by DAY_SCALE,
+  plus the average change in activity between consecutive days of the 7 days
+  before _now. Each day is computed as a column across all of the rows.
+
+  Parameters
+    rows: A list of activity series. See Topic.series.
+    _now: The date to rank for.
+  Returns
+    A list of weekly ranks, formatted like Topic.weekly_rank, one per row.
+  """
+  days = (_now - LOCAL_EPOCH).days
+  columns = []
+  for offset in range(7, 0, -1):
+    day = days - offset
+    column = []
+    for row in rows:
+      index = day - row[0]
+      if 0 <= index < len(row) - 2:
+        column.append(row[len(row) - index - 1])
+      else:
+        column.append(0)
+    columns.append(column)
+
+  totals = [0.0] * len(rows)
+  for before, after in zip(columns[:-1], columns[1:]):
+    totals = [
+        total + (p and float(q) / p)
+        for total, p, q in zip(totals, before, after)
+        ]
+  changes = len(columns) - 1
+  return ["%20f" % (days * DAY_SCALE + total / changes) for total in totals]
+
+def burst_scores(rows, hour):
+  """Scores how far the hourly activity of many topics is above their own
+  baseline, as the number of standard deviations the count of hour is from
+  the mean of the BURST_HOURS - 1 hours before it.
+
+  The deviation is at least 1, so that topics which are usually quiet don't
+  burst on a single tweet.
+
+  Parameters
+    rows: A list of pairs of hourly ring and newest hour counted in it. See
+      Topic.record_hourly.
+    hour: The hour to score, in hours since the local epoch.
+  Returns
+    A list of pairs of score and count of hour, one per row.
+  """
+  hours = range(hour - BURST_HOURS + 1, hour + 1)
+  scores = []
+  for ring, latest in rows:
+    counts = []
+    for past in hours:
+      if latest - BURST_HOURS < past <= latest:
+        counts.append(ring[past % BURST_HOURS])
+      else:
+        counts.append(0)
+    count = counts.pop()
+    mean = sum(counts) / float(len(counts))
+    variance = sum([(other - mean) ** 2 for other in counts]) / len(counts)
+    deviation = max(math.sqrt(variance), 1.0)
+    scores.append(((count - mean) / deviation, count))
+  return scores
+
+def epoch_hours(when):
+  """Returns the number of whole hours from the local epoch to a date."""
+  delta = when - LOCAL_EPOCH
+  return delta.days * 24 + delta.seconds / 3600
+
+def series_to_blob(series):
+  """Encodes an activity series as unsigned 32 bit little endian numbers.
+
+  Parameters
+    series: An array of numbers.
+  Returns
+    A string.
+  """
+  if sys.byteorder == 'big':
+    series = array('I', series)
+    series.byteswap()
+  return series.tostring()
+
+def blob_to_series(blob):
+  """Decodes an activity series encoded by series_to_blob.
+
+  Parameters
+    blob: A string.
+  Returns
+    An array of numbers.
+  """
+  series = array('I')
+  series.fromstring(blob)
+  if sys.byteorder == 'big':
+    series.byteswap()
+  return series
 
 def int_to_uni(number):
   """Converts an integer into a unicode character.
@@ -435,13 +1620,172 @@ def uni_to_int(char):
 class Settings(db.Model):
   value = db.StringProperty(required=True)
 
+  def get_value(name, default=None):
+    """Returns the value of a setting, cached in memcache.
+
+    Parameters
+      name: Name of the setting.
+      default: Returned when the setting does not exist.
+    Returns
+      The value of the setting as a string, or default.
+    """
+    value = memcache.get('setting:' + name)
+    if value is None:
+      setting = Settings.get_by_key_name('key:' + name)
+      value = setting and setting.value or ''
+      memcache.set('setting:' + name, value)
+    return value or default
+  get_value = staticmethod(get_value)
+
+  def get_flag(name):
+    """Returns whether a setting is on. Any value but "1", "true", "yes" or
+    "on", in any case, is off, so that a setting can be turned off from
+    /settings.
+
+    Parameters
+      name: Name of the setting.
+    Returns
+      True if the setting is on.
+    """
+    return Settings.get_value(name, '').strip().lower() in FLAG_VALUES
+  get_flag = staticmethod(get_flag)
+
+  def flush(name):
+    """Removes the cached value of a setting."""
+    memcache.delete('setting:' + name)
+  flush = staticmethod(flush)
+
+class FetchList(db.Model):
+  """The timelines and searches downloaded by Fetch. They are kept apart from
+  Settings, whose values cannot hold more than 500 characters.
+  """
+  urls = db.StringListProperty()
+
+  KEY_NAME = 'fetch_urls'
+  MEMCACHE_KEY = 'fetch-urls'
+
+  def get_urls(default=None):
+    """Returns the URLs to download, cached in memcache. Before the list is
+    first stored, the URLs are read from the fetch_urls setting, separated by
+    whitespace.
+
+    Parameters
+      default: Returned when no URLs are listed.
+    Returns
+      A list of URLs, or default.
+    """
+    urls = memcache.get(FetchList.MEMCACHE_KEY)
+    if urls is None:
+      fetch_list = FetchList.get_by_key_name(FetchList.KEY_NAME)
+      if fetch_list:
+        urls = fetch_list.urls
+      else:
+        urls = Settings.get_value('fetch_urls', '').split()
+      memcache.set(FetchList.MEMCACHE_KEY, urls)
+    return urls or default
+  get_urls = staticmethod(get_urls)
+
+  def set_urls(urls):
+    """Stores the URLs to download, skipping blank and repeated entries.
+
+    Parameters
+      urls: A list of URLs.
+    Returns
+      The key of the FetchList.
+    """
+    unique = []
+    for url in urls:
+      url = url.strip()
+      if url and url not in unique:
+        unique.append(url)
+    key = FetchList(key_name=FetchList.KEY_NAME, urls=unique).put()
+    memcache.delete(FetchList.MEMCACHE_KEY)
+    return key
+  set_urls = staticmethod(set_urls)
+
+def touch_topics(keys):
+  """Marks Topics as changed, so that pages cached for them are rendered
+  again. The generation of a Topic is the time it last changed.
+
+  Parameters
+    keys: A list of encoded Topic keys.
+  """
+  now = time.time()
+  memcache.set_multi(
+      dict([(key, now) for key in keys]), key_prefix='generation:'
+      )
+
+def incr_counter(key, delta=1, time=0):
+  """Adds to a counter in memcache, creating it if it does not exist.
+
+  Parameters
+    key: The memcache key.
+    delta: The amount to add.
+    time: When a new counter expires. See memcache.add.
+  Returns
+    The new value, or None if the counter could not be created.
+  """
+  value = memcache.incr(key, delta)
+  if value is None:
+    if memcache.add(key, delta, time):
+      return delta
+    value = memcache.incr(key, delta)
+  return value
+
+def record_stats(counts):
+  """Adds to counters kept in memcache, for monitoring.
+
+  Parameters
+    counts: A dict of counter names to the amount to add.
+  """
+  for name, delta in counts.items():
+    if incr_counter('stats:' + name, delta) == delta:
+      names = memcache.get('stats') or []
+      if name not in names:
+        memcache.set('stats', sorted(names + [name]))
+
+def get_stats():
+  """Returns the counters kept by record_stats.
+
+  Returns
+    A dict of counter names to their values.
+  """
+  return memcache.get_multi(memcache.get('stats') or [], key_prefix='stats:')
+
+MONTHS = dict(zip(
+    "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split(), range(1, 13)
+    ))
+CREATED_AT_CACHE_SIZE = 256
+_created_at_cache = {}
+
 def parse_created_at(created_at):
   """Takes a date string and parses it to a DateTime object.
 
+  Twitter dates have a fixed layout, e.g. "Mon Aug 10 21:24:24 +0000 2009", so
+  the fields are sliced out instead of using strptime, which is slow. Tweets
+  in the same batch are often created in the same second, so recent results
+  are cached.
+
   Parameters
     created_at: String representation of a date.
   Returns
     DateTime object.
   """
-  created_at_notz = created_at[:19] + created_at[25:]
-  return datetime.strptime(created_at_notz, "%a %b %d %H:%M:%S %Y")
+  parsed = _created_at_cache.get(created_at)
+  if parsed is None:
+    try:
+      parsed = datetime(
+          int(created_at[26:]),
+          MONTHS[created_at[4:7]],
+          int(created_at[8:10]),
+          int(created_at[11:13]),
+          int(created_at[14:16]),
+          int(created_at[17:19])
+          )
+    except (KeyError, ValueError):
+      created_at_notz = created_at[:19] + created_at[25:]
+      parsed = datetime.strptime(created_at_notz, "%a %b %d %H:%M:%S %Y")
+    if len(_created_at_cache) >= CREATED_AT_CACHE_SIZE:
+      _created_at_cache.clear()
+    _created_at_cache[created_at] = parsed
+  return parsed
@@ -8,67 +8,713 @@ from google.appengine.api import urlfetch_errors
 from google.appengine.api.labs import taskqueue
 from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.runtime import DeadlineExceededError
 from django.utils import simplejson
 
 from models import *
+from bloom import BloomFilter
 
-import pickle
 import wsgiref.handlers
+import hashlib
+import heapq
 import logging
+import random
 import re
 import time
 
 MAX_TWEETS = 40
+# Most old Tweets deleted by one truncate task.
+TRUNCATE_BATCH = 400
+# A Topic is queued for truncation at most once every TRUNCATE_WINDOW seconds.
+TRUNCATE_WINDOW = 60
+# Seconds a fetch may have taken and still process the timeline inline.
+INLINE_BUDGET = 5
+# Seconds to wait for timelines to download.
+FETCH_DEADLINE = 10
+PUBLIC_TIMELINE = "http://twitter.com/statuses/public_timeline.json"
+# Most Batches processed by one ETL task, unless set by etl_batches.
+ETL_BATCHES = 10
+# Seconds spent finding pending Batches to process together.
+ETL_DRAIN_BUDGET = 2
+# Seconds a Batch is claimed by an ETL task.
+CLAIM_TIME = 120
+# Seconds to wait before retrying a Batch claimed by another task.
+CLAIM_RETRY = 30
+# Records processed between checks of the time left to an ETL task.
+ETL_SLICE = 100
+# Seconds an ETL task may spend before leaving the rest to another task.
+ETL_BUDGET = 15
+# Activity is counted in memcache, and written to Topics once per window of
+# ACTIVITY_WINDOW seconds. Windows are kept for ACTIVITY_WINDOWS windows in
+# case a flush is missed.
+ACTIVITY_WINDOW = 300
+ACTIVITY_WINDOWS = 12
+ACTIVITY_SHARDS = 4
+# Topics fetched at a time when ranking, and seconds a ranking task may spend.
+RANK_PAGE = 500
+RANK_BUDGET = 20
+# Number of Topics kept in the trending list.
+TRENDING_SIZE = 20
+# Memcache key held while Topics are written in bulk, and for how long.
+TOPIC_LOCK = 'topic-lock'
+LOCK_TIME = 60
+# Bursting Topics score at least BURST_THRESHOLD, unless set by
+# burst_threshold, and have at least BURST_MIN_COUNT tweets in the hour.
+BURST_THRESHOLD = 3.0
+BURST_MIN_COUNT = 5
+# Topics fetched at a time when detecting bursts.
+BURST_PAGE = 500
+# Seconds of an hour which are flushed before the hour is scored for bursts.
+# Until then the hour before is scored.
+BURST_WARMUP = 900
+# Days Tweets are kept, unless set by retention_days.
+RETENTION_DAYS = 30
+# Old Tweets deleted at a time, Tweets checked for orphans at a time, and
+# seconds a sweep task may spend.
+SWEEP_BATCH = 500
+SWEEP_PAGE = 200
+SWEEP_BUDGET = 20
+# How the cutoff of a sweep is passed to the task continuing it.
+SWEEP_TIME = '%Y-%m-%dT%H:%M:%S'
+
+def process_records(records):
+  """Associates TweetRecords with Topics, stores the Tweets which are on topic,
+  and queues the tasks which follow from them.
+
+  The strategy used for associating Tweets and Topics is to build a list of
+  possible topics for each Tweet. It's useful to think of this process in two
+  parts: the first concerns itself with topics that are a single word,
+  and the second, with topics comprising multiple words.
+
+  Activity is counted last, so that if processing fails before it,
+  processing the same records again does not count them twice. Records which
+  were processed recently are dropped.
+
+  Parameters
+    records: A list of TweetRecords.
+  """
+  unseen = TweetRecord.drop_seen(records)
+  if records:
+    record_stats({
+      'seen.batches': 1,
+      'seen.records': len(records),
+      'seen.duplicates': len(records) - len(unseen),
+      })
+    logging.info("Dropped %d of %d tweets seen before." %
+        (len(records) - len(unseen), len(records))
+        )
+  records = unseen
+  if not records:
+    return
+
+  matcher = TopicMatcher.load()
+  if matcher is None and memcache.add('compile-matcher', True, 600):
+    taskqueue.add(url='/tasks/compilematcher')
+
+  bloom = None
+  if matcher is None:
+    bloom = BloomFilter.load(TOPIC_BLOOM)
+    if bloom is None and memcache.add('build-bloom', True, 600):
+      taskqueue.add(url='/tasks/buildbloom')
+
+  mode = Settings.get_value('link_mode', 'phrase')
+  stats = {}
+  tweets_by_topic = Topic.link_topics(
+      records, matcher, frontier=(mode == 'frontier'), stats=stats,
+      bloom=bloom
+      )
+  if 'keys_per_level' in stats:
+    counts = {'link.%s.batches' % mode: 1}
+    for level, count in enumerate(stats['keys_per_level']):
+      counts['link.%s.level%d' % (mode, level + 1)] = count
+    if bloom is not None:
+      counts['bloom.batches'] = 1
+      counts['bloom.skipped'] = stats['bloom_skipped']
+      counts['bloom.false_positives'] = stats['bloom_false_positives']
+    record_stats(counts)
+
+  ontopic = set()
+  topic_activity = {}
+  for topic, topic_records in tweets_by_topic.items():
+    topic_activity[str(topic.key())] = len(topic_records)
+    ontopic.update(topic_records)
+
+  tweets = {}
+  for record in ontopic:
+    tweet = record.to_tweet()
+    if tweet:
+      tweets[record] = tweet
+  db.put(tweets.values())
+  tweets_by_key = {}
+  for topic, topic_records in tweets_by_topic.items():
+    tweets_by_key[str(topic.key())] = [tweets[record]
+                                       for record in topic_records
+                                       if record in tweets]
+  TopicSnapshot.update(tweets_by_key)
+  touch_topics(topic_activity.keys())
+
+  full = []
+  for key, count in topic_activity.items():
+    stored = memcache.incr('stored:' + key, count)
+    # A missing counter is set by the truncate task.
+    if stored is None or stored >= MAX_TWEETS:
+      full.append(key)
+  queue_truncate(full)
+
+  aggregate_activity(topic_activity, len(records))
+  TweetRecord.remember(records)
+
+def queue_truncate(keys, _now=None):
+  """Queues one task to truncate several Topics. See truncate_topics.
+
+  Each Topic is only queued once per window of TRUNCATE_WINDOW seconds, and
+  the task is named after the window and the Topics, so queueing the same
+  Topics again, as a retry does, is rejected.
+
+  Parameters
+    keys: A list of encoded Topic keys.
+  """
+  window = int((_now or time.time()) / TRUNCATE_WINDOW)
+  keys = [key for key in keys
+          if memcache.add('truncate:%d:%s' % (window, key), True,
+                          TRUNCATE_WINDOW * 2)]
+  if not keys:
+    return
+
+  keys.sort()
+  try:
+    taskqueue.Task(
+        url='/tasks/truncate', params={'key': keys},
+        name='truncate-%d-%s' % (window, hashlib.md5(''.join(keys)).hexdigest())
+        ).add('truncate')
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+def truncate_topics(keys):
+  """Keeps the newest MAX_TWEETS / 2 Tweets of each Topic which has
+  MAX_TWEETS, with a keys-only query per Topic and batched deletes. The
+  Tweets deleted are removed from the snapshots of the Topics. Also sets the
+  counters of Tweets stored which process_records checks before queueing
+  truncation.
+
+  Parameters
+    keys: A list of encoded Topic keys.
+  Returns
+    A list of the keys of Topics which may still have too many Tweets.
+  """
+  # Share TRUNCATE_BATCH deletes between the Topics.
+  limit = max(MAX_TWEETS, MAX_TWEETS / 2 + TRUNCATE_BATCH / len(keys))
+  old = []
+  counts = {}
+  truncated = {}
+  unfinished = []
+  for key in keys:
+    query = Tweet.all(keys_only=True).filter('topics =', db.Key(key))
+    tweets = query.order('-created_at').fetch(limit)
+    if len(tweets) < MAX_TWEETS:
+      counts[key] = len(tweets)
+      continue
+    old.extend(tweets[MAX_TWEETS / 2:])
+    counts[key] = MAX_TWEETS / 2
+    truncated[key] = [tweet.name().split(':', 1)[1]
+                      for tweet in tweets[MAX_TWEETS / 2:]]
+    if len(tweets) == limit:
+      unfinished.append(key)
+
+  # Tweets can be old in several Topics.
+  old = list(set(old))
+  for start in range(0, len(old), TRUNCATE_BATCH):
+    db.delete(old[start:start + TRUNCATE_BATCH])
+  memcache.set_multi(counts, key_prefix='stored:')
+  TopicSnapshot.forget(truncated)
+  touch_topics(truncated.keys())
+  logging.info("Deleted %d tweets from %d topics." % (len(old), len(keys)))
+  return unfinished
+
+def aggregate_activity(topic_activity, batchsize, _now=None):
+  """Adds the activity of Topics to counters in memcache, which are written
+  to the Topics by flush_activity once every ACTIVITY_WINDOW seconds.
+
+  Counters are split into ACTIVITY_SHARDS shards, picked at random, so that
+  concurrent tasks don't update the same counter.
+
+  Parameters
+    topic_activity: A dict of encoded Topic keys to the number of tweets
+      associated with the Topic.
+    batchsize: The number of tweets processed.
+  """
+  window = int((_now or time.time()) / ACTIVITY_WINDOW)
+  expires = ACTIVITY_WINDOW * (ACTIVITY_WINDOWS + 2)
+  shard = random.randrange(ACTIVITY_SHARDS)
+
+  incr_counter('activity-size:%d:%d' % (window, shard), batchsize, expires)
+  for key, count in topic_activity.items():
+    incr_counter('activity:%d:%s:%d' % (window, key, shard), count, expires)
+    # Keep a list of the Topics in the window, adding each only once.
+    if memcache.add('activity-seen:%d:%s' % (window, key), True, expires):
+      slot = incr_counter('activity-slots:%d' % window, 1, expires)
+      memcache.set('activity-slot:%d:%d' % (window, slot), key, expires)
+
+def flush_activity(window):
+  """Records the activity counted by aggregate_activity in a window of time,
+  with one batched get and put of the Topics.
+
+  Parameters
+    window: The window, in units of ACTIVITY_WINDOW seconds since the epoch.
+  """
+  slotcount = memcache.get('activity-slots:%d' % window) or 0
+  slots = memcache.get_multi(
+      [str(slot) for slot in range(1, slotcount + 1)],
+      key_prefix='activity-slot:%d:' % window
+      )
+  keys = set(slots.values())
+  counterkeys = ['%s:%d' % (key, shard)
+                 for key in keys for shard in range(ACTIVITY_SHARDS)]
+  counters = memcache.get_multi(counterkeys, key_prefix='activity:%d:' % window)
+  sizes = memcache.get_multi(
+      [str(shard) for shard in range(ACTIVITY_SHARDS)],
+      key_prefix='activity-size:%d:' % window
+      )
+
+  topic_activity = {}
+  for key in keys:
+    topic_activity[key] = sum(
+        [counters.get('%s:%d' % (key, shard), 0)
+         for shard in range(ACTIVITY_SHARDS)]
+        )
+  # If memcache evicted some batch sizes, don't let a topic have more tweets
+  # than the window.
+  batchsize = max([sum(sizes.values())] + topic_activity.values())
+
+  if topic_activity:
+    now = datetime.utcfromtimestamp(window * ACTIVITY_WINDOW)
+    topics = Topic.get([db.Key(key) for key in keys])
+    topics = [topic for topic in topics if topic]
+    for topic in topics:
+      try:
+        topic.record_activity(
+            topic_activity[str(topic.key())], batchsize, _now=now
+            )
+      except (ValueError, OverflowError), e:
+        logging.error("Could not record activity of %s: %s" % (topic.name, e))
+      topic.record_hourly(topic_activity[str(topic.key())], _now=now)
+    db.put(topics)
+    logging.info("Recorded activity of %d topics." % len(topics))
+
+  memcache.delete_multi(
+      ['activity-slots:%d' % window] +
+      ['activity-slot:%d:%s' % (window, slot) for slot in slots] +
+      ['activity-seen:%d:%s' % (window, key) for key in keys] +
+      ['activity:%d:%s' % (window, key) for key in counterkeys] +
+      ['activity-size:%d:%d' % (window, shard)
+       for shard in range(ACTIVITY_SHARDS)]
+      )
+
+def rank_topics(topics, trending, _now):
+  """Recalculates the weekly rank of Topics, in bulk. See rank_series.
+
+  Parameters
+    topics: A list of Topics.
+    trending: A list of the highest ranked Topics so far, as tuples of weekly
+      rank, name and encoded key.
+    _now: The date to rank for.
+  Returns
+    A tuple of the list of Topics whose rank changed, and trending updated
+    with the Topics.
+  """
+  # Topics which only begin longer topics have no activity.
+  topics = [topic for topic in topics if topic.key().name().startswith('key:')]
+  ranks = rank_series([topic.decode_series() for topic in topics], _now)
+
+  changed = []
+  for topic, rank in zip(topics, ranks):
+    if topic.weekly_rank != rank:
+      topic.weekly_rank = rank
+      changed.append(topic)
+
+  trending = heapq.nlargest(TRENDING_SIZE, trending + [
+      (float(rank), topic.name, str(topic.key()))
+      for topic, rank in zip(topics, ranks)
+      ])
+  return changed, trending
+
+def detect_bursts(topics, hour, threshold=BURST_THRESHOLD):
+  """Finds the Topics whose activity in an hour bursts above their own
+  baseline. See burst_scores.
+
+  Parameters
+    topics: A list of Topics.
+    hour: The hour, in hours since the local epoch.
+    threshold: The lowest score of a burst.
+  Returns
+    A list of the bursting Topics, as tuples of score, name, encoded key and
+    number of tweets in the hour.
+  """
+  scores = burst_scores(
+      [(topic.hourly_ring(), topic.hourly_at) for topic in topics], hour
+      )
+  bursts = []
+  for topic, (score, count) in zip(topics, scores):
+    if score >= threshold and count >= BURST_MIN_COUNT:
+      bursts.append((score, topic.name, str(topic.key()), count))
+  return bursts
+
+def sweep_old(cutoff, cursor, start):
+  """Deletes Tweets created before a date, with a keys-only query and
+  batched deletes, until none are left or SWEEP_BUDGET seconds have passed
+  since start. Then removes them from the snapshots which held them, see
+  TopicSnapshot.prune, and marks those Topics as changed, see touch_topics.
+
+  Parameters
+    cutoff: The date.
+    cursor: The cursor to continue deleting from, or None to start.
+    start: When the task started, in seconds since the epoch.
+  Returns
+    The cursor to continue from, which is empty to start again, or None if
+    no Tweets created before cutoff are left.
+  """
+  query = Tweet.all(keys_only=True).filter('created_at <', cutoff)
+  if cursor:
+    query.with_cursor(cursor)
+  deleted = 0
+  try:
+    while True:
+      if time.time() - start > SWEEP_BUDGET:
+        return cursor or ''
+      keys = query.fetch(SWEEP_BATCH)
+      if not keys:
+        break
+      db.delete(keys)
+      deleted += len(keys)
+      cursor = query.cursor()
+      query.with_cursor(cursor)
+  finally:
+    logging.info("Deleted %d tweets older than %s." % (deleted, cutoff))
+
+  snapshots = TopicSnapshot.all(keys_only=True).filter('oldest <', cutoff)
+  while time.time() - start < SWEEP_BUDGET:
+    keys = snapshots.fetch(SWEEP_PAGE)
+    if not keys:
+      return None
+    touch_topics(TopicSnapshot.prune([key.name() for key in keys], cutoff))
+    snapshots.with_cursor(snapshots.cursor())
+  return cursor or ''
+
+def sweep_orphans(cursor, start):
+  """Walks Tweets from oldest to newest, removing the keys of Topics which
+  no longer exist from their topics, and deleting Tweets left without any,
+  until SWEEP_BUDGET seconds have passed since start. The Topics which no
+  longer exist are marked as changed, see touch_topics.
+
+  Parameters
+    cursor: The cursor to continue from, or None to start from the oldest.
+    start: When the task started, in seconds since the epoch.
+  Returns
+    The cursor to continue from, or None if every Tweet was checked.
+  """
+  query = Tweet.all().order('created_at')
+  if cursor:
+    query.with_cursor(cursor)
+  orphaned = 0
+  try:
+    while time.time() - start < SWEEP_BUDGET:
+      tweets = query.fetch(SWEEP_PAGE)
+      if not tweets:
+        return None
+
+      keys = set()
+      for tweet in tweets:
+        keys.update(tweet.topics)
+      topics = keys and Topic.get(list(keys)) or []
+      existing = set([topic.key() for topic in topics if topic])
+
+      orphans = []
+      changed = []
+      for tweet in tweets:
+        live = [key for key in tweet.topics if key in existing]
+        if not live:
+          orphans.append(tweet)
+        elif len(live) < len(tweet.topics):
+          tweet.topics = live
+          changed.append(tweet)
+      db.delete(orphans)
+      db.put(changed)
+      missing = [str(key) for key in keys if key not in existing]
+      TopicSnapshot.discard(missing)
+      touch_topics(missing)
+      orphaned += len(orphans)
+      query.with_cursor(query.cursor())
+    return query.cursor()
+  finally:
+    logging.info("Deleted %d orphaned tweets." % orphaned)
+
+def fetch_timelines(urls, deadline=FETCH_DEADLINE):
+  """Downloads several timelines at once.
+
+  Every download is started before waiting for any of them, and they share
+  the same deadline.
+
+  Parameters
+    urls: List of URLs of timelines or searches.
+    deadline: Seconds to wait for the downloads.
+  Returns
+    A list of the contents of the downloads which succeeded.
+  """
+  rpcs = []
+  for url in urls:
+    rpc = urlfetch.create_rpc(deadline=deadline)
+    urlfetch.make_fetch_call(rpc, url)
+    rpcs.append((url, rpc))
+
+  contents = []
+  for url, rpc in rpcs:
+    try:
+      response = rpc.get_result()
+      if response.status_code == 200:
+        contents.append(response.content)
+      else:
+        logging.info("Fetch of %s failed, got response %d" %
+            (url, response.status_code)
+            )
+    except urlfetch_errors.DownloadError, e:
+      logging.info("%s responded too slowly. %s" % (url, e.message))
+  return contents
+
+def merge_timelines(contents):
+  """Merges the JSON of several timelines or searches into one list of items,
+  without repeating any tweet.
+
+  Parameters
+    contents: List of JSON strings.
+  Returns
+    A list of items, shaped like the public timeline JSON.
+  """
+  items = []
+  ids = set()
+  for content in contents:
+    try:
+      timeline = simplejson.loads(content)
+    except ValueError, e:
+      logging.info("Could not decode timeline. %s" % e)
+      continue
+    if isinstance(timeline, dict):
+      timeline = [from_search_result(result)
+                  for result in timeline.get('results', [])]
+    for item in timeline:
+      if item['id'] not in ids:
+        ids.add(item['id'])
+        items.append(item)
+  return items
+
+def from_search_result(result):
+  """Converts a result from the search API to an item of the public timeline.
+
+  Search results don't include how many followers and friends the author has,
+  so both are taken to be 1.
+
+  Parameters
+    result: A result decoded from the search API JSON.
+  Returns
+    An item, shaped like the public timeline JSON.
+  """
+  # "Mon, 10 Aug 2009 21:24:24 +0000" becomes "Mon Aug 10 21:24:24 +0000 2009"
+  weekday, day, month, year, clock, zone = \
+      result['created_at'].replace(',', '').split()
+  return {
+      'id': result['id'],
+      'text': result['text'],
+      'created_at': ' '.join([weekday, month, day.zfill(2), clock, zone, year]),
+      'user': {
+        'screen_name': result['from_user'],
+        'profile_image_url': result['profile_image_url'],
+        'followers_count': 1,
+        'friends_count': 1,
+        },
+      }
+
+def claim_batches(batch):
+  """Claims a Batch, and as many other pending Batches as the etl_batches
+  setting allows, so they can be processed together. Consecutive batches share
+  most of their words, so processing them together saves datastore lookups.
+
+  A claim is an entry in memcache, which stops other tasks from processing the
+  same Batch until it is released or expires.
+
+  Parameters
+    batch: The Batch the task was queued for.
+  Returns
+    A list of the Batches claimed, oldest first. Empty if the Batch was already
+    claimed.
+  """
+  start = time.time()
+  if not memcache.add('etl-claim:%d' % batch.key().id(), True, CLAIM_TIME):
+    return []
+
+  batches = [batch]
+  limit = int(Settings.get_value('etl_batches', ETL_BATCHES))
+  for pending in Batch.all().order('created_at').fetch(limit):
+    if len(batches) >= limit or time.time() - start > ETL_DRAIN_BUDGET:
+      break
+    if pending.key() == batch.key():
+      continue
+    if memcache.add('etl-claim:%d' % pending.key().id(), True, CLAIM_TIME):
+      batches.append(pending)
+
+  batches.sort(key=lambda claimed: claimed.created_at)
+  return batches
+
+def release_batches(batches):
+  """Releases the claims on Batches. See claim_batches.
+
+  Parameters
+    batches: A list of Batches.
+  """
+  memcache.delete_multi(
+      ['etl-claim:%d' % batch.key().id() for batch in batches]
+      )
+
+def process_slices(pending, start, attempt=0):
+  """Processes the records of Batches in slices of ETL_SLICE records, until
+  they are done or ETL_BUDGET seconds have passed since start.
+
+  After each slice the Batches which are done are deleted, and the progress of
+  a Batch which is partly done is stored, so that a retry resumes from there.
+  If time runs out, a task is queued to continue.
+
+  Parameters
+    pending: A list of pairs of Batch and the records left to process in it.
+      It is updated as slices are processed.
+    start: When the task started, in seconds since the epoch.
+    attempt: The number of tasks which continued before this one.
+  """
+  while pending:
+    if time.time() - start > ETL_BUDGET:
+      continue_later(pending, attempt)
+      return
+
+    records = []
+    done = []
+    taken = 0
+    for batch, batch_records in pending:
+      room = ETL_SLICE - len(records)
+      if len(batch_records) > room:
+        taken = room
+        records.extend(batch_records[:taken])
+        break
+      records.extend(batch_records)
+      done.append(batch)
+
+    process_records(records)
+
+    db.delete(done)
+    del pending[:len(done)]
+    if taken:
+      batch, batch_records = pending[0]
+      batch.progress += taken
+      batch.put()
+      pending[0] = (batch, batch_records[taken:])
+
+def continue_later(pending, attempt=0):
+  """Queues a task to process the rest of the Batches. The task is named
+  after the progress made and the attempt, so it is only queued once, even by
+  a continuation which made no progress.
+
+  Parameters
+    pending: A list of pairs of Batch and the records left to process in it.
+    attempt: The number of tasks which continued before this one.
+  """
+  batch = pending[0][0]
+  attempt += 1
+  logging.info("Continuing Batch %d from record %d in another task." %
+      (batch.key().id(), batch.progress)
+      )
+  try:
+    taskqueue.Task(
+        url='/tasks/etl',
+        params={'batch_id': batch.key().id(), 'attempt': attempt},
+        name='etl-%d-%d-%d' % (batch.key().id(), batch.progress, attempt)
+        ).add('etl')
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+def retry_claim(batch_id, attempt, retry):
+  """Queues a task to process a Batch after CLAIM_RETRY seconds. A Batch which
+  was claimed by another task is left to that task, but it may have claimed
+  it as an extra Batch and run out of time before reaching it, or died
+  holding the claim, so the Batch is checked again later. A retry finds the
+  Batch deleted once it is done, or claims it once the claim expires.
+
+  Parameters
+    batch_id: The ID of the Batch.
+    attempt: The number of tasks which continued the Batch.
+    retry: The number of retries queued for the Batch, including this one.
+  """
+  try:
+    taskqueue.Task(
+        url='/tasks/etl',
+        params={'batch_id': batch_id, 'attempt': attempt, 'retry': retry},
+        name='etl-retry-%d-%d-%d' % (batch_id, attempt, retry),
+        countdown=CLAIM_RETRY
+        ).add('etl')
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
 
 class QueueFetch(webapp.RequestHandler):
   """Puts a task on the fetch queue."""
 
   def get(self):
-    """Called by cron to queue a download of the public timeline."""
-    url = "http://twitter.com/statuses/public_timeline.json"
-    task = taskqueue.Task(
-        url='/tasks/fetch',
-        params={'url': url}
-        )
-    task.add('fetch')
+    """Called by cron to queue a download of the timelines in the FetchList,
+    or of the public timeline. The URLs are read by the task, so that a long
+    list does not outgrow the task payload.
+    """
+    taskqueue.Task(url='/tasks/fetch').add('fetch')
 
 class Fetch(webapp.RequestHandler):
   """Handles requests to download the public timeline."""
 
   def post(self):
-    """Downloads the public timeline, creates a Batch from it, stores the Batch
+    """Downloads the timelines, creates a Batch from them, stores the Batch
     to the database, and creates a task to process the Batch created.
+
+    If the inline_etl setting is on, and the download left enough time, the
+    timeline is processed here instead. The Batch is only stored if that
+    fails.
     """
-    url = self.request.get('url')
-    try:
-      response = urlfetch.fetch(url)
-      if response.status_code == 200:
-        items = simplejson.loads(response.content)
-        key = Batch(pickled_items=pickle.dumps(items)).put()
-        if key:
-          taskqueue.Task(
-              url='/tasks/etl',
-              params={'batch_id': key.id()}
-              ).add('etl')
-      else:
-        logging.info("Fetch failed, got response %d" % response.status_code)
-    except urlfetch_errors.DownloadError, e:
-      logging.info("Twitter responded too slowly. %s" % e.message)
+    start = time.time()
+    urls = self.request.get('urls').split() or \
+           self.request.get_all('url') or \
+           FetchList.get_urls([PUBLIC_TIMELINE])
+    items = merge_timelines(fetch_timelines(urls))
+    if not items:
+      return
+
+    if Settings.get_flag('inline_etl') and \
+       time.time() - start < INLINE_BUDGET:
+      try:
+        process_records(Tweet.from_items(items))
+        return
+      except (DeadlineExceededError, Exception), e:
+        logging.warning("Inline ETL failed, queueing the batch. %s" % e)
+    key = Batch.from_items(items).put()
+    if key:
+      taskqueue.Task(
+          url='/tasks/etl',
+          params={'batch_id': key.id()}
+          ).add('etl')
 
 class ETL(webapp.RequestHandler):
   """Handles request to process Batches."""
 
   def post(self):
-    """Converts Batches to Tweets, and associates Tweets with Topics.
-
-    The strategy used for associating Tweets and Topics is to build a list of
-    possible topics for each Tweet. It's useful to think of this process in two
-    parts: the first concerns itself with topics that are a single word,
-    and the second, with topics comprising multiple words.
+    """Converts Batches to Tweets, and associates Tweets with Topics. See
+    process_records.
     """
+    start = time.time()
     try:
       id = self.request.get('batch_id')
       batch = Batch.get_by_id(long(id))
+      attempt = int(self.request.get('attempt') or 0)
+      retry = int(self.request.get('retry') or 0)
     except ValueError:
       # Flush tasks with bad batch ids
       self.response.set_status(200)
@@ -78,42 +724,242 @@ class ETL(webapp.RequestHandler):
       logging.warning("Batch not found %s." % id)
       return
 
-    alltweets = Tweet.from_batch(batch)
-    tweets_by_topic = Topic.link_topics(alltweets)
-    ontopic = set()
-    topic_activity = {}
-    for topic, tweets in tweets_by_topic.items():
-      key = str(topic.key())
-      topic_activity[key] = len(tweets)
-      ontopic.update(tweets)
+    batches = claim_batches(batch)
+    if not batches:
+      logging.info("Batch %s is being processed by another task." % id)
+      retry_claim(batch.key().id(), attempt, retry + 1)
+      return
+
+    try:
+      pending = [(batch, Tweet.from_batch(batch)[batch.progress:])
+                 for batch in batches]
+      try:
+        process_slices(pending, start, attempt)
+      except DeadlineExceededError:
+        continue_later(pending, attempt)
+    finally:
+      release_batches(batches)
+
+class CompileMatcher(webapp.RequestHandler):
+  """Handles requests to compile every Topic into a TopicMatcher."""
+
+  def get(self):
+    """Called by cron to keep the TopicMatcher up to date."""
+    self.post()
+
+  def post(self):
+    """Compiles the TopicMatcher and stores it in memcache, with the Topics
+    created while compiling. See TopicMatcher.publish.
+    """
+    # Topics are created with the clock of another server.
+    started = datetime.now() - timedelta(minutes=1)
+    matcher = TopicMatcher.compile()
+    Topic.record_length(matcher.depth, scanned=True)
+    matcher.publish(started)
+    memcache.delete('compile-matcher')
+
+class BuildBloom(webapp.RequestHandler):
+  """Handles requests to build the BloomFilter of topics."""
+
+  def get(self):
+    """Called by cron to keep the BloomFilter up to date."""
+    self.post()
+
+  def post(self):
+    """Builds the BloomFilter and stores it in memcache."""
+    Topic.build_bloom()
+    memcache.delete('build-bloom')
+
+class Stats(webapp.RequestHandler):
+  """Handles requests for the counters kept by record_stats."""
+
+  def get(self):
+    """Returns the counters as JSON."""
+    stats = get_stats()
+
+    bloom = BloomFilter.load(TOPIC_BLOOM)
+    if bloom is not None:
+      stats['bloom.expected_false_positive_rate'] = bloom.error_rate()
+    # Keys which were skipped were not topics, so together with the false
+    # positives they are every key which was not a topic.
+    negatives = stats.get('bloom.skipped', 0) + \
+        stats.get('bloom.false_positives', 0)
+    if negatives:
+      stats['bloom.false_positive_rate'] = \
+          stats.get('bloom.false_positives', 0) / float(negatives)
+    if stats.get('seen.records'):
+      stats['seen.duplicate_ratio'] = \
+          stats.get('seen.duplicates', 0) / float(stats['seen.records'])
+
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(simplejson.dumps(stats))
+
+class Truncate(webapp.RequestHandler):
+  """Handles requests to delete the oldest Tweets of Topics."""
+
+  def post(self):
+    """Truncates the Topics given as key parameters. See truncate_topics.
+    Topics which may have more Tweets to delete are queued again.
+    """
+    keys = self.request.get_all('key')
+    if not keys:
+      return
+    unfinished = truncate_topics(keys)
+    if unfinished:
       taskqueue.Task(
-          url='/tasks/truncate', params={'key': key}
+          url='/tasks/truncate', params={'key': unfinished}
           ).add('truncate')
 
-    taskqueue.add(
-        url='/tasks/activity',
-        params={
-          'values': simplejson.dumps(topic_activity),
-          'batchsize': len(alltweets)
-          }
-        )
+class FlushActivity(webapp.RequestHandler):
+  """Handles requests to write the activity counted in memcache to Topics."""
 
-    batch.delete()
-    db.put(ontopic)
+  def get(self):
+    """Called by cron every ACTIVITY_WINDOW seconds."""
+    self.post()
 
-class Truncate(webapp.RequestHandler):
+  def post(self):
+    """Flushes every window which has ended, leaving one window for tasks
+    which were still counting when it ended.
+    """
+    if not memcache.add(TOPIC_LOCK, True, LOCK_TIME):
+      logging.info("Topics are being ranked, flushing later.")
+      return
+    try:
+      window = int(time.time() / ACTIVITY_WINDOW)
+      for past in range(window - ACTIVITY_WINDOWS, window - 1):
+        flush_activity(past)
+      memcache.set('activity-flushed', window - 2)
+    finally:
+      memcache.delete(TOPIC_LOCK)
+
+class RankTopics(webapp.RequestHandler):
+  """Handles requests to recalculate the weekly rank of every Topic, so that
+  Topics which are no longer mentioned don't keep their rank.
+  """
+
+  def get(self):
+    """Called by cron to start ranking."""
+    self.post()
 
   def post(self):
-    key = db.Key(self.request.get('key'))
-    topic = Topic.get(key)
+    """Ranks pages of Topics until RANK_BUDGET seconds have passed, then
+    queues a task to continue from the last page. The last task stores the
+    highest ranked Topics in memcache, under "trending".
+    """
+    start = time.time()
+    job = self.request.get('job') or str(int(start))
+    cursor = self.request.get('cursor')
+
+    # Flushing activity and ranking both write Topics.
+    if not memcache.add(TOPIC_LOCK, True, LOCK_TIME):
+      taskqueue.Task(
+          url='/tasks/rank', params={'job': job, 'cursor': cursor},
+          countdown=LOCK_TIME
+          ).add()
+      return
+
+    try:
+      now = datetime.utcnow()
+      trending = memcache.get('trending:' + job) or []
+      query = Topic.all()
+      if cursor:
+        query.with_cursor(cursor)
+      while time.time() - start < RANK_BUDGET:
+        topics = query.fetch(RANK_PAGE)
+        if not topics:
+          memcache.set('trending', trending)
+          memcache.delete('trending:' + job)
+          return
+        changed, trending = rank_topics(topics, trending, now)
+        db.put(changed)
+        query.with_cursor(query.cursor())
+
+      memcache.set('trending:' + job, trending, 3600)
+      taskqueue.Task(
+          url='/tasks/rank', params={'job': job, 'cursor': query.cursor()}
+          ).add()
+    finally:
+      memcache.delete(TOPIC_LOCK)
+
+class DetectBursts(webapp.RequestHandler):
+  """Handles requests to find the Topics which are bursting."""
+
+  def get(self):
+    """Called by cron every few minutes."""
+    self.post()
+
+  def post(self):
+    """Scores the Topics counted in the latest hour flushed by FlushActivity,
+    and stores the highest scoring bursts in memcache, under "bursts".
+
+    Hourly counts only reach Topics when a window is flushed, so an hour is
+    scored once BURST_WARMUP seconds of it have been flushed. Until then the
+    hour before it is scored again, now that all of it has been flushed.
+    """
+    flushed = memcache.get('activity-flushed')
+    if flushed is None:
+      logging.info("No activity flushed, not detecting bursts.")
+      return
+    flushed_at = datetime.utcfromtimestamp((flushed + 1) * ACTIVITY_WINDOW)
+    hour = epoch_hours(flushed_at - timedelta(0, BURST_WARMUP))
+
+    threshold = float(Settings.get_value('burst_threshold', BURST_THRESHOLD))
+    bursts = []
+    query = Topic.all().filter('hourly_at >=', hour)
+    topics = query.fetch(BURST_PAGE)
+    while topics:
+      bursts = heapq.nlargest(
+          TRENDING_SIZE, bursts + detect_bursts(topics, hour, threshold)
+          )
+      query.with_cursor(query.cursor())
+      topics = query.fetch(BURST_PAGE)
+    memcache.set('bursts', bursts)
+    logging.info("Found %d bursting topics." % len(bursts))
+
+class Sweep(webapp.RequestHandler):
+  """Handles requests to delete Tweets which are too old, or which no
+  longer belong to any Topic, so that the Tweets stored stay bounded.
+  """
+
+  def get(self):
+    """Called by cron to start a sweep, unless one is still going."""
+    if memcache.get('sweeping'):
+      return
+    self.post()
+
+  def post(self):
+    """Deletes Tweets older than the retention_days setting, then looks for
+    orphaned Tweets from the cursor in the sweep_cursor setting. See sweep_old
+    and sweep_orphans. Queues a task to continue if time runs out.
+    """
+    start = time.time()
+    memcache.set('sweeping', True, SWEEP_BUDGET * 3)
+
+    # A cursor only continues the query with the same cutoff.
+    cutoff = self.request.get('cutoff')
+    if cutoff:
+      cutoff = datetime.strptime(cutoff, SWEEP_TIME)
+    else:
+      days = int(Settings.get_value('retention_days', RETENTION_DAYS))
+      cutoff = (datetime.utcnow() - timedelta(days)).replace(microsecond=0)
+    cursor = sweep_old(cutoff, self.request.get('old_cursor'), start)
+    if cursor is not None:
+      taskqueue.Task(url='/tasks/sweep', params={
+          'cutoff': cutoff.strftime(SWEEP_TIME), 'old_cursor': cursor
+          }).add()
+      return
 
-    if not topic:
-      self.error(404)
+    cursor = sweep_orphans(Settings.get_value('sweep_cursor'), start)
+    if cursor:
+      Settings(key_name='key:sweep_cursor', value=cursor).put()
+    else:
+      db.delete(db.Key.from_path('Settings', 'key:sweep_cursor'))
+    Settings.flush('sweep_cursor')
+    if not cursor:
+      memcache.delete('sweeping')
       return
 
-    if topic.tweets.count(MAX_TWEETS) >= MAX_TWEETS:
-      db.delete(topic.tweets.order("created_at").fetch(MAX_TWEETS / 2))
-      logging.info("Deleted %d tweets from %s." % (MAX_TWEETS / 2, topic.name))
+    taskqueue.Task(url='/tasks/sweep').add()
 
 class Activity(webapp.RequestHandler):
 
@@ -124,6 +970,7 @@ class Activity(webapp.RequestHandler):
     def increment_activity(topic_key, activity):
       topic = Topic.get(topic_key)
       topic.record_activity(activity, batchsize)
+      topic.record_hourly(activity)
       db.put(topic)
 
     for encoded, activity in topic_activity.items():
@@ -137,7 +984,14 @@ application = webapp.WSGIApplication([
   ('/tasks/fetch', Fetch),
   ('/tasks/etl', ETL),
   ('/tasks/activity', Activity),
+  ('/tasks/flushactivity', FlushActivity),
+  ('/tasks/rank', RankTopics),
+  ('/tasks/bursts', DetectBursts),
+  ('/tasks/sweep', Sweep),
   ('/tasks/truncate', Truncate),
+  ('/tasks/compilematcher', CompileMatcher),
+  ('/tasks/buildbloom', BuildBloom),
+  ('/tasks/stats', Stats),
 ], debug=True)
 
 def main():
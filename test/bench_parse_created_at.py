@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""Compares parse_created_at with the strptime parser it replaced.
+
+Run from the application directory, with the App Engine SDK on the path:
+
+  python test/bench_parse_created_at.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from datetime import datetime
+
+import models
+
+def strptime_created_at(created_at):
+  """The strptime parser which parse_created_at replaced."""
+  created_at_notz = created_at[:19] + created_at[25:]
+  return datetime.strptime(created_at_notz, "%a %b %d %H:%M:%S %Y")
+
+def batch(seconds):
+  """Returns the dates of a batch of 20 tweets made in a number of seconds."""
+  return [
+      "Mon Aug 10 21:24:%02d +0000 2009" % (n % seconds) for n in range(20)
+      ]
+
+def main():
+  for seconds in [1, 5, 20]:
+    dates = batch(seconds)
+    for date in dates:
+      assert models.parse_created_at(date) == strptime_created_at(date)
+
+    def strptime_batch():
+      for date in dates:
+        strptime_created_at(date)
+
+    def fast_batch():
+      models._created_at_cache.clear()
+      for date in dates:
+        models.parse_created_at(date)
+
+    old = min(timeit.Timer(strptime_batch).repeat(3, 1000))
+    new = min(timeit.Timer(fast_batch).repeat(3, 1000))
+    print "%2d distinct dates: strptime %.3fs, parse_created_at %.3fs (%.1fx)" % (
+        seconds, old, new, old / new
+        )
+
+if __name__ == '__main__':
+  main()
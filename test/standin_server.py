@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""A stand-in for the Twitter API, serving canned timelines for test_tasks.
+
+Run it before running the tests:
+
+  python test/standin_server.py [port]
+"""
+
+import sys
+import time
+
+def item(id, text):
+  """Returns an item of the public timeline."""
+  return {
+      "id": id,
+      "text": text,
+      "created_at": "Mon Aug 10 21:24:%02d +0000 2009" % id,
+      "user": {
+        "profile_image_url": "http://example.com/%d.png" % id,
+        "screen_name": "standin%d" % id,
+        "followers_count": 10,
+        "friends_count": 10,
+        },
+      }
+
+def result(id, text):
+  """Returns a result of the search API."""
+  return {
+      "id": id,
+      "text": text,
+      "created_at": "Mon, 10 Aug 2009 21:24:%02d +0000" % id,
+      "from_user": "standin%d" % id,
+      "profile_image_url": "http://example.com/%d.png" % id,
+      }
+
+TIMELINES = {
+    "/public.json": [item(1, "One"), item(2, "Two"), item(3, "Three")],
+    "/friends.json": [item(3, "Three"), item(4, "Four")],
+    "/search.json": {"results": [result(4, "Four"), result(5, "Five")]},
+    }
+
+def main():
+  import BaseHTTPServer
+  import SocketServer
+  try:
+    import json as simplejson
+  except ImportError:
+    from django.utils import simplejson
+
+  class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    pass
+
+  class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      path, _, query = self.path.partition('?')
+      if query.startswith('delay='):
+        time.sleep(float(query[len('delay='):]))
+      if path not in TIMELINES:
+        self.send_error(404)
+        return
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.end_headers()
+      self.wfile.write(simplejson.dumps(TIMELINES[path]))
+
+  port = len(sys.argv) > 1 and int(sys.argv[1]) or 8081
+  Server(('localhost', port), Handler).serve_forever()
+
+if __name__ == '__main__':
+  main()
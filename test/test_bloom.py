@@ -0,0 +1,40 @@
+import unittest
+
+from bloom import BloomFilter
+from google.appengine.api import memcache
+
+class TestBloom(unittest.TestCase):
+
+  def test_membership(self):
+    bloom = BloomFilter.with_capacity(1000)
+    for n in range(1000):
+      bloom.add("parent:%d" % n)
+
+    # No false negatives
+    for n in range(1000):
+      self.assertTrue("parent:%d" % n in bloom)
+
+    # About one percent false positives
+    positives = [n for n in range(1000) if "key:%d" % n in bloom]
+    self.assertTrue(len(positives) < 50)
+    self.assertTrue(bloom.error_rate() < 0.02)
+
+  def test_memcache(self):
+    self.assertEqual(None, BloomFilter.load("test-bloom"))
+
+    bloom = BloomFilter.with_capacity(100)
+    bloom.add(u"key:caf\xe9")
+    self.assertTrue(bloom.save("test-bloom"))
+
+    loaded = BloomFilter.load("test-bloom")
+    self.assertTrue(u"key:caf\xe9" in loaded)
+    self.assertEqual(1, loaded.count)
+
+    changed = loaded.add("key:tea")
+    loaded.save("test-bloom", changed)
+    self.assertTrue("key:tea" in BloomFilter.load("test-bloom"))
+
+    memcache.delete("test-bloom")
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,221 @@
+import unittest
+import StringIO
+import email.utils
+import time
+import urllib
+
+from main import write_json, TopicDetail
+from models import Topic, Tweet, TopicSnapshot
+from tasks import sweep_old
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+from google.appengine.api import memcache
+from django.utils import simplejson
+from datetime import datetime, timedelta
+
+class TestMain(unittest.TestCase):
+
+  def tweets(self):
+    tweets = []
+    contents = [u"Caf\xe9 \"quoted\"", u"\u65e5\u672c @name"]
+    for n, content in enumerate(contents):
+      tweets.append(Tweet(
+          key_name='tweet:%d' % n, content=content,
+          created_at=datetime(2009, 8, 10, 21, 24, n),
+          pic_url="http://example.com/%d.png" % n, author="author%d" % n,
+          source_id=str(n), influence="%020d|%d" % (n, n)
+          ))
+    return tweets
+
+  def handler(self, path, environ={}):
+    handler = TopicDetail()
+    handler.initialize(webapp.Request.blank(path, environ), webapp.Response())
+    return handler
+
+  def get(self, name, format, query='', environ={}):
+    """Runs a TopicDetail request, and returns the handler."""
+    path = '/topics/%s.%s' % (urllib.quote(name), format)
+    if query:
+      path += '?' + query
+    handler = self.handler(path, environ)
+    handler.get(urllib.quote(name), format)
+    return handler
+
+  def test_validate(self):
+    modified = 1250000000.5
+    etag = '"abc"'
+    handler = self.handler('/topics/validate.json')
+    self.failIf(handler.validate(etag, modified))
+    self.assertEqual(etag, handler.response.headers['ETag'])
+    self.assertEqual(
+        'Tue, 11 Aug 2009 14:13:20 GMT',
+        handler.response.headers['Last-Modified']
+        )
+
+    def validate(environ):
+      handler = self.handler('/topics/validate.json', environ)
+      return handler.validate(etag, modified)
+
+    for match in [etag, '"other", ' + etag, '*']:
+      self.assertTrue(validate({'HTTP_IF_NONE_MATCH': match}))
+    self.failIf(validate({'HTTP_IF_NONE_MATCH': '"other"'}))
+
+    since = email.utils.formatdate(modified, usegmt=True)
+    earlier = email.utils.formatdate(modified - 60, usegmt=True)
+    self.assertTrue(validate({'HTTP_IF_MODIFIED_SINCE': since}))
+    self.failIf(validate({'HTTP_IF_MODIFIED_SINCE': earlier}))
+    self.failIf(validate({'HTTP_IF_MODIFIED_SINCE': 'Not a date'}))
+    # If-Modified-Since is ignored when there is an If-None-Match.
+    self.failIf(validate({
+        'HTTP_IF_NONE_MATCH': '"other"', 'HTTP_IF_MODIFIED_SINCE': since
+        }))
+
+  def test_conditional_get(self):
+    # A missing topic has no validators, and no generation.
+    handler = self.get('validators', 'json', environ={
+        'HTTP_IF_NONE_MATCH': '*'
+        })
+    self.assertEqual(404, handler.response.status)
+    self.assertEqual(None, handler.response.headers.get('ETag'))
+    topic = Topic.from_tokens('validators')[-1]
+    key = str(topic.key())
+    self.assertEqual(None, memcache.get('generation:' + key))
+
+    topic.put()
+    old = self.tweets()[0]
+    old.topics = [topic.key()]
+    old.put()
+    TopicSnapshot.update({key: []})
+
+    handler = self.get('validators', 'json')
+    self.assertEqual(200, handler.response.status)
+    etag = handler.response.headers['ETag']
+    modified = handler.response.headers['Last-Modified']
+    for environ in [{'HTTP_IF_NONE_MATCH': etag},
+                    {'HTTP_IF_MODIFIED_SINCE': modified}]:
+      handler = self.get('validators', 'json', environ=environ)
+      self.assertEqual(304, handler.response.status)
+      self.assertEqual('', handler.response.out.getvalue())
+    # Another page of the same topic has another ETag.
+    handler = self.get('validators', 'json', 'limit=1', {
+        'HTTP_IF_NONE_MATCH': etag
+        })
+    self.assertEqual(200, handler.response.status)
+
+    # Sweeping the Tweet changes the generation of the topic.
+    self.assertEqual(None, sweep_old(datetime(2009, 8, 11), None, time.time()))
+    handler = self.get('validators', 'json', environ={
+        'HTTP_IF_NONE_MATCH': etag
+        })
+    self.assertEqual(200, handler.response.status)
+    self.assertNotEqual(etag, handler.response.headers['ETag'])
+    self.assertEqual([], simplejson.loads(handler.response.out.getvalue()))
+
+    db.delete(topic)
+    memcache.delete('generation:' + key)
+
+  def pages(self, name, params):
+    """Follows the Older cursors of a topic from its first page, and returns
+    the IDs of the Tweets shown and the cursors followed.
+    """
+    ids = []
+    cursors = []
+    while len(cursors) < 10:
+      query = params
+      if cursors:
+        query += '&' + urllib.urlencode({'cursor': cursors[-1]})
+      handler = self.get(name, 'json', query)
+      self.assertEqual(200, handler.response.status)
+      items = simplejson.loads(handler.response.out.getvalue())
+      ids.extend([item['source_id'] for item in items])
+      cursor = handler.response.headers.get('X-Next-Cursor')
+      if not cursor:
+        return ids, cursors
+      cursors.append(cursor)
+    self.fail("Too many pages of %s" % name)
+
+  def test_cursor_paging(self):
+    topic = Topic.from_tokens('paging')[-1]
+    topic.put()
+    key = str(topic.key())
+    start = datetime(2009, 8, 10)
+    tweets = []
+    # Pairs of Tweets are created in the same second, so some pages end
+    # between Tweets with the same date.
+    for n in range(25):
+      tweets.append(Tweet(
+          key_name='tweet:%d' % (100 + n), content="Page %d" % n,
+          created_at=start + timedelta(0, n / 2),
+          pic_url="http://example.com/", author="author",
+          source_id=str(100 + n), topics=[topic.key()],
+          influence="%020d|%d" % (n % 5, 100 + n)
+          ))
+    db.put(tweets)
+    TopicSnapshot.update({key: []})
+    tweets_by_id = dict([(tweet.source_id, tweet) for tweet in tweets])
+
+    for order in ['-created_at', '-influence', 'created_at']:
+      ids, cursors = self.pages('paging', 'limit=7&order=' + order)
+      # No Tweet is shown twice, or left out.
+      self.assertEqual(len(set(ids)), len(ids))
+      self.assertEqual(sorted(tweets_by_id.keys()), sorted(ids))
+      name = order.lstrip('-')
+      values = [getattr(tweets_by_id[id], name) for id in ids]
+      self.assertEqual(sorted(values, reverse=order[0] == '-'), values)
+      self.assertEqual(3, len(cursors))
+      # Orders kept by the snapshot continue from keysets.
+      self.assertEqual(
+          order in TopicSnapshot.ORDERS, cursors[0].startswith('after:')
+          )
+
+    for params in [{'cursor': 'garbage'},
+                   {'cursor': 'after:garbage'},
+                   {'cursor': 'after:2009-08-10 100'},
+                   {'cursor': 'after:2009-08-10T00:00:00 100',
+                    'order': 'created_at'}]:
+      handler = self.get('paging', 'json', urllib.urlencode(params))
+      self.assertEqual(400, handler.response.status)
+
+    db.delete(tweets + [topic, TopicSnapshot.get_by_key_name(key)])
+    memcache.delete('generation:' + key)
+
+  def test_write_json(self):
+    tweets = self.tweets()
+    out = StringIO.StringIO()
+    write_json(out, tweets)
+
+    # The fields written by reflecting over the properties, before
+    # write_json. Markup is only used by the html format.
+    expected = []
+    for tweet in tweets:
+      item = {}
+      for property in tweet.properties():
+        if property in ['topics', 'influence', 'markup']:
+          continue
+        if 'created_at' == property:
+          item[property] = tweet.created_at.isoformat() + 'Z'
+        else:
+          item[property] = unicode(getattr(tweet, property))
+      item['source_url'] = tweet.source_url()
+      expected.append(item)
+    self.assertEqual(expected, simplejson.loads(out.getvalue()))
+
+    out = StringIO.StringIO()
+    write_json(out, [])
+    self.assertEqual([], simplejson.loads(out.getvalue()))
+
+  def test_write_ndjson(self):
+    tweets = self.tweets()
+    out = StringIO.StringIO()
+    write_json(out, tweets, lines=True)
+
+    lines = out.getvalue().split('\n')
+    self.assertEqual('', lines.pop())
+    self.assertEqual(len(tweets), len(lines))
+    for tweet, line in zip(tweets, lines):
+      item = simplejson.loads(line)
+      self.assertEqual(tweet.content, item['content'])
+      self.assertEqual(tweet.source_url(), item['source_url'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,9 +2,14 @@ import unittest
 import logging
 import pickle
 
-from models import Topic, Tweet, Batch
-from models import int_to_uni, uni_to_int
+from models import Topic, Tweet, Batch, TopicMatcher, TweetRecord, Settings
+from models import TopicSnapshot, SNAPSHOT_SIZE, tweet_markup
+from models import int_to_uni, uni_to_int, rank_series
+from models import burst_scores, epoch_hours, BURST_HOURS
+from models import TOPIC_BLOOM, TOPIC_BLOOM_LOCK, FetchList
+from bloom import BloomFilter
 from google.appengine.ext import db
+from google.appengine.api import memcache
 from google.appengine.api import apiproxy_stub_map
 from datetime import datetime, timedelta
 
@@ -68,6 +73,149 @@ class TestModels(unittest.TestCase):
 
     self.assertTrue("like son" in topic_names)
 
+  def test_link_by_level(self):
+    tweet = Tweet(content="Like father, like son. His name is Robert Paulson")
+    stats = {}
+    topics = Topic.link_topics(tweet, frontier=True, stats=stats)
+    topic_names = [topic.name for topic in topics.keys()]
+
+    self.assertEqual(
+        sorted(["name", "like son", "robert paulson"]),
+        sorted(topic_names)
+        )
+    self.assertEqual(len(topics), len(tweet.topics))
+    # Words, then the children of "like" and "robert", which are not parents.
+    self.assertEqual(2, len(stats['keys_per_level']))
+    self.assertEqual(2 * 3, stats['keys_per_level'][1])
+
+  def test_phrase_bound(self):
+    words = ["stop%d" % n for n in range(20)]
+    nodes = []
+    for word in words:
+      nodes.extend(Topic.from_tokens([word, "word"]))
+    db.put(nodes)
+    Topic.record_length(2, scanned=True)
+
+    # Every word begins a topic, but no phrase is longer than two words.
+    tweet = Tweet(content=' '.join(words))
+    stats = {}
+    Topic.link_topics(tweet, stats=stats)
+    self.assertEqual(2, len(stats['keys_per_level']))
+    self.assertEqual(len(words), stats['keys_per_level'][0])
+    self.assertTrue(stats['keys_per_level'][1] < 2 * len(words))
+
+    db.delete(nodes)
+    db.delete(db.Key.from_path('Settings', 'key:longest_topic'))
+    Settings.flush('longest_topic')
+
+  def test_matcher(self):
+    matcher = TopicMatcher.compile()
+    self.assertEqual(
+        ["robert", "paulson"],
+        Topic.path_tokens(db.Key.from_path(*Topic.create_path(
+          ["robert", "paulson"]
+          )))
+        )
+
+    tweet = Tweet(content="His name is Robert Paulson, like son")
+    topics = Topic.link_topics(tweet, matcher)
+    topic_names = [topic.name for topic in topics.keys()]
+    self.assertTrue("name" in topic_names)
+    self.assertTrue("robert paulson" in topic_names)
+    self.assertTrue("like son" in topic_names)
+    self.failIf("robert" in topic_names)
+
+    keys = [str(topic.key()) for topic in topics.keys()]
+    self.assertEqual(sorted(keys), sorted(map(str, tweet.topics)))
+
+  def test_matcher_storage(self):
+    matcher = TopicMatcher()
+    for n in range(5000):
+      matcher.add(["storage", "topic", str(n)])
+    self.assertTrue(matcher.save())
+
+    loaded = TopicMatcher.load()
+    self.assertEqual(3, loaded.depth)
+    self.assertEqual(
+        [("storage", "topic", "4999")],
+        loaded.match(["storage", "topic", "4999"])
+        )
+    # The same version is not decoded again.
+    self.assertTrue(loaded is TopicMatcher.load())
+
+    version = loaded.version
+    TopicMatcher.add_topic(["storage", "topic", "new"])
+    self.assertNotEqual(version, TopicMatcher.load().version)
+    self.assertEqual(
+        [("storage", "topic", "new")],
+        TopicMatcher.load().match(["storage", "topic", "new"])
+        )
+
+    # While another task changes the matcher, adding a topic drops it.
+    memcache.add(TopicMatcher.LOCK_KEY, True)
+    TopicMatcher.add_topic(["storage", "topic", "locked"])
+    self.assertEqual(None, TopicMatcher.load())
+    memcache.delete(TopicMatcher.LOCK_KEY)
+
+    # Topics created while compiling are published with the matcher.
+    started = datetime.now() - timedelta(minutes=1)
+    nodes = Topic.from_tokens(["published", "late"])
+    db.put(nodes)
+    self.assertTrue(TopicMatcher().publish(started))
+    self.assertEqual(
+        [("published", "late")],
+        TopicMatcher.load().match(["published", "late"])
+        )
+    db.delete(nodes)
+
+    memcache.delete(TopicMatcher.MEMCACHE_KEY)
+    self.assertEqual(None, TopicMatcher.load())
+
+  def test_topic_bloom(self):
+    Topic.build_bloom()
+    nodes = Topic.from_tokens(["bloom", "added"])
+    db.put(nodes)
+    Topic.add_to_bloom(nodes)
+    bloom = BloomFilter.load(TOPIC_BLOOM)
+    for node in nodes:
+      self.assertTrue(Topic.bloom_name(node.key()) in bloom)
+
+    # While another task changes the filter, adding a topic drops it.
+    memcache.add(TOPIC_BLOOM_LOCK, True)
+    Topic.add_to_bloom(nodes)
+    self.assertEqual(None, BloomFilter.load(TOPIC_BLOOM))
+    memcache.delete(TOPIC_BLOOM_LOCK)
+
+    db.delete(nodes)
+    memcache.delete(TOPIC_BLOOM)
+    db.delete(db.Key.from_path('Settings', 'key:longest_topic'))
+    Settings.flush('longest_topic')
+
+  def test_fetch_list(self):
+    memcache.delete(FetchList.MEMCACHE_KEY)
+    self.assertEqual(None, FetchList.get_urls())
+    # The fetch_urls setting is read until a list is stored.
+    Settings(key_name='key:fetch_urls', value='http://a/ http://b/').put()
+    Settings.flush('fetch_urls')
+    self.assertEqual(['http://a/', 'http://b/'], FetchList.get_urls())
+
+    # More URLs than a setting can hold.
+    urls = ['http://search.twitter.com/search.json?q=%d' % n
+            for n in range(50)]
+    self.assertTrue(len(' '.join(urls)) > 500)
+    FetchList.set_urls(urls + [' ', urls[0]])
+    self.assertEqual(urls, FetchList.get_urls())
+    memcache.delete(FetchList.MEMCACHE_KEY)
+    self.assertEqual(urls, FetchList.get_urls())
+
+    FetchList.set_urls([])
+    self.assertEqual([], FetchList.get_urls([]))
+
+    db.delete([db.Key.from_path('FetchList', FetchList.KEY_NAME),
+               db.Key.from_path('Settings', 'key:fetch_urls')])
+    Settings.flush('fetch_urls')
+    memcache.delete(FetchList.MEMCACHE_KEY)
+
   def test_unicode_storage(self):
     for n in range(65535):
       self.assertEquals(uni_to_int(int_to_uni(n)), n)
@@ -98,6 +246,31 @@ class TestModels(unittest.TestCase):
 
     db.delete(topic_nodes)
 
+  def test_activity_series(self):
+    epoch = datetime(2009, 7, 12)
+    topic = Topic.from_tokens("series_test_topic")[-1]
+    # Stored before activity_series existed
+    topic.activity = int_to_uni(3) + int_to_uni(40) + int_to_uni(500) + \
+        57 * u"\x00"
+    topic.put()
+
+    topic = Topic.get(topic.key())
+    self.assertEqual(None, topic.activity_series)
+    self.assertEqual(500, topic.get_activity(_now=epoch + timedelta(60)))
+
+    topic.set_activity(0x10ffff, _now=epoch + timedelta(61))
+    topic.put()
+
+    topic = Topic.get(topic.key())
+    self.assertEqual(4 * 60, len(topic.activity_series))
+    self.assertEqual(0x10ffff, topic.get_activity(_now=epoch + timedelta(61)))
+    self.assertEqual(500, topic.get_activity(_now=epoch + timedelta(60)))
+    # The activity string is kept in step.
+    self.assertEqual(4, uni_to_int(topic.activity[0]))
+    self.assertEqual(0x10ffff, uni_to_int(topic.activity[2]))
+
+    db.delete(topic)
+
   def test_activity_order(self):
     # Create topics
     ramen_nodes = Topic.from_tokens("ramen")
@@ -148,8 +321,63 @@ class TestModels(unittest.TestCase):
     self.assertEqual(1, len(tweets))
     self.assertEqual("His name is Robert Paulson", tweets[0].content)
 
+    Topic.link_topics(tweets)
+    tweet = tweets[0].to_tweet()
+    self.assertEqual("tweet:1234", tweet.key().name())
+    self.assertEqual(datetime(2009, 8, 10, 21, 24, 24), tweet.created_at)
+    self.assertEqual(2, len(tweet.topics))
+    self.assertEqual("His name is Robert Paulson", tweet.markup)
+
+    db.delete(key)
+
+  def test_encoded_batch(self):
+    items = []
+    for n in range(300):
+      items.append({
+          "text": u"Caf\xe9 number %d" % n,
+          "created_at": "Mon Aug 10 21:24:24 +0000 2009",
+          "id": 5000000000 + n,
+          "user": {
+            "profile_image_url": "http://example.com/%d.png" % n,
+            "screen_name": "Jack%d" % n,
+            "followers_count": n,
+            "friends_count": 100,
+            "description": "Not kept",
+            },
+          })
+
+    key = Batch.from_items(items).put()
+    batch = Batch.get(key)
+    decoded = list(batch.iter_items())
+
+    self.assertEqual(len(items), len(decoded))
+    for item, decoded_item in zip(items, decoded):
+      self.assertEqual(item["id"], decoded_item["id"])
+      self.assertEqual(item["text"], decoded_item["text"])
+      self.assertEqual(
+          item["user"]["screen_name"], decoded_item["user"]["screen_name"]
+          )
+      self.failIf("description" in decoded_item["user"])
+
+    # The first item has no followers
+    self.assertEqual(len(items) - 1, len(Tweet.from_batch(batch)))
+    self.assertTrue(len(batch.encoded_items) < len(pickle.dumps(items)))
+
     db.delete(key)
 
+  def test_seen_records(self):
+    def record(id):
+      return TweetRecord({"id": id, "text": "Tweet %d" % id})
+
+    first = [record(1), record(2), record(2)]
+    self.assertEqual([1, 2], [r.id for r in TweetRecord.drop_seen(first)])
+    TweetRecord.remember(first)
+
+    second = [record(2), record(3)]
+    self.assertEqual([3], [r.id for r in TweetRecord.drop_seen(second)])
+
+    memcache.delete_multi(TweetRecord.seen_keys())
+
   def test_trend_ranking(self):
     nodes = Topic.from_tokens("ender") + Topic.from_tokens("valentine")
     db.put(nodes)
@@ -182,6 +410,105 @@ class TestModels(unittest.TestCase):
 
     db.delete(nodes)
 
+  def test_rank_series(self):
+    epoch = datetime(2009, 7, 12)
+    topics = [Topic.from_tokens(name)[-1] for name in ["bean", "peter"]]
+    for day in range(20):
+      topics[0].record_activity(day, _now=epoch + timedelta(day))
+      topics[1].record_activity(20 - day, _now=epoch + timedelta(day))
+
+    # Ranking in bulk agrees with ranking each topic as it is recorded.
+    ranks = rank_series(
+        [topic.series() for topic in topics], epoch + timedelta(19)
+        )
+    self.assertEqual([topic.weekly_rank for topic in topics], ranks)
+    self.assertTrue(ranks[0] > ranks[1])
+
+  def test_hourly_bursts(self):
+    epoch = datetime(2009, 7, 12)
+    steady, burst = [Topic.from_tokens(name)[-1] for name in ["han", "solo"]]
+    for hour in range(BURST_HOURS + 10):
+      now = epoch + timedelta(0, 3600 * hour)
+      steady.record_hourly(3 + hour % 2, _now=now)
+      burst.record_hourly(hour % 2, _now=now)
+    burst.record_hourly(20, _now=now)
+
+    hour = epoch_hours(now)
+    self.assertEqual(hour, burst.hourly_at)
+    self.assertEqual(21, burst.hourly_ring()[hour % BURST_HOURS])
+    # Counts older than the ring are dropped.
+    steady.record_hourly(100, _now=epoch)
+    self.assertEqual(4 * BURST_HOURS, len(steady.hourly))
+
+    (steady_score, _), (burst_score, count) = burst_scores(
+        [(topic.hourly_ring(), topic.hourly_at) for topic in [steady, burst]],
+        hour
+        )
+    self.assertEqual(21, count)
+    self.assertTrue(steady_score < 3)
+    self.assertTrue(burst_score > 3)
+
+    # A quiet hour clears the buckets it skips.
+    later = hour + BURST_HOURS / 2
+    burst.record_hourly(1, _now=now + timedelta(0, 3600 * BURST_HOURS / 2))
+    ring = burst.hourly_ring()
+    self.assertEqual(1, ring[later % BURST_HOURS])
+    self.assertEqual(0, ring[(later - 1) % BURST_HOURS])
+
+  def test_tweet_markup(self):
+    markup = tweet_markup(u"@tyler see http://example.com/soap")
+    self.assertTrue(
+        markup.startswith(u'<a href="http://twitter.com/tyler">@tyler</a>')
+        )
+    self.assertTrue(u'href="http://example.com/soap"' in markup)
+    self.assertEqual(u"No links", tweet_markup(u"No links"))
+
+  def test_topic_snapshot(self):
+    topic = Topic.from_tokens("snapshot")[-1]
+    topic.put()
+    key = str(topic.key())
+    start = datetime(2009, 8, 10)
+
+    def tweet(n, influence):
+      return Tweet(
+          key_name='tweet:%d' % n, content=u"Caf\xe9 %d" % n,
+          created_at=start + timedelta(0, n), pic_url="http://example.com/",
+          author="author", source_id=str(n), topics=[topic.key()],
+          influence="%020d|%d" % (influence, n)
+          )
+
+    stored = tweet(0, 100)
+    stored.put()
+    TopicSnapshot.update({key: [tweet(n, n) for n in range(1, SNAPSHOT_SIZE)]})
+    TopicSnapshot.update({key: [tweet(SNAPSHOT_SIZE, 0)]})
+
+    snapshot = TopicSnapshot.get_by_key_name(key)
+    recent = snapshot.tweets('-created_at')
+    self.assertEqual(
+        [str(n) for n in range(SNAPSHOT_SIZE, 0, -1)],
+        [tweet.source_id for tweet in recent]
+        )
+    self.assertEqual(u"Caf\xe9 %d" % SNAPSHOT_SIZE, recent[0].content)
+    influential = snapshot.tweets('-influence')
+    # The snapshot was started from the Tweet already stored.
+    self.assertEqual('0', influential[0].source_id)
+    self.assertEqual(SNAPSHOT_SIZE, len(influential))
+
+    # With more Tweets than it holds, a Tweet after the last one held is left
+    # out of that order.
+    self.failIf(snapshot.complete)
+    later = tweet(SNAPSHOT_SIZE + 1, 0)
+    self.assertTrue(snapshot.drop(set(['0'])))
+    snapshot.merge([later])
+    self.assertEqual(
+        str(SNAPSHOT_SIZE + 1), snapshot.tweets('-created_at')[0].source_id
+        )
+    influential = snapshot.tweets('-influence')
+    self.assertEqual(SNAPSHOT_SIZE - 1, len(influential))
+    self.assertEqual('1', influential[-1].source_id)
+
+    db.delete([snapshot, stored, topic])
+
   def setUp(self):
     # Multiword topics are a linked nodes, i.e., robert => paulson
     nodes = Topic.from_tokens(Topic.tokenize("Robert Paulson"))
@@ -0,0 +1,361 @@
+import unittest
+import logging
+import os
+import time
+import tasks
+
+from tasks import fetch_timelines, merge_timelines
+from tasks import aggregate_activity, flush_activity, ACTIVITY_WINDOW
+from tasks import truncate_topics, MAX_TWEETS
+from tasks import sweep_old, sweep_orphans
+from tasks import process_slices, ETL_SLICE
+from tasks import claim_batches, release_batches
+from models import Batch, Settings
+from models import Topic, Tweet, TopicSnapshot, MAX_ACTIVITY
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from google.appengine.api import urlfetch_errors
+from django.utils import simplejson
+from datetime import datetime, timedelta
+from standin_server import TIMELINES
+
+STANDIN_URL = os.environ.get('EDROP_STANDIN_URL', 'http://localhost:8081')
+
+class TestTasks(unittest.TestCase):
+
+  def test_merge_timelines(self):
+    contents = [simplejson.dumps(timeline) for timeline in TIMELINES.values()]
+    contents.append("Not JSON")
+    items = merge_timelines(contents)
+
+    self.assertEqual([1, 2, 3, 4, 5], sorted([item['id'] for item in items]))
+    search_item = [item for item in items if item['id'] == 5][0]
+    self.assertEqual("standin5", search_item['user']['screen_name'])
+    self.assertEqual(
+        "Mon Aug 10 21:24:05 +0000 2009", search_item['created_at']
+        )
+
+  def test_aggregate_activity(self):
+    nodes = Topic.from_tokens("aggregate")
+    db.put(nodes)
+    key = str(nodes[-1].key())
+
+    now = datetime(2009, 8, 10)
+    timestamp = (now - datetime(1970, 1, 1)).days * 86400
+    window = timestamp / ACTIVITY_WINDOW
+    for n in range(4):
+      aggregate_activity({key: 3}, 20, _now=timestamp)
+    flush_activity(window)
+
+    topic = Topic.get(key)
+    self.assertEqual(
+        int(12 / 80.0 * MAX_ACTIVITY), topic.get_activity(_now=now)
+        )
+
+    # The counters are gone, so a second flush records nothing.
+    flush_activity(window)
+    self.assertEqual(topic.activity, Topic.get(key).activity)
+
+    db.delete(nodes)
+
+  def test_process_slices(self):
+    def items(first, count):
+      return [{
+          "id": n,
+          "text": "Slice %d" % n,
+          "created_at": "Mon Aug 10 21:24:24 +0000 2009",
+          "user": {
+            "profile_image_url": "http://example.com/",
+            "screen_name": "slicer",
+            "followers_count": 1,
+            "friends_count": 1,
+            },
+          } for n in range(first, first + count)]
+
+    first = Batch.from_items(items(0, ETL_SLICE + 50))
+    second = Batch.from_items(items(ETL_SLICE + 50, 80))
+    db.put([first, second])
+
+    slices = []
+    interrupted = []
+    def process_records(records):
+      if len(slices) == 2 and not interrupted:
+        interrupted.append(True)
+        raise RuntimeError("Interrupted")
+      slices.append([record.id for record in records])
+
+    original = tasks.process_records
+    tasks.process_records = process_records
+    try:
+      pending = [(batch, Tweet.from_batch(batch)) for batch in [first, second]]
+      self.assertRaises(
+          RuntimeError, process_slices, pending, time.time()
+          )
+      # A slice ends inside the first Batch, the next one spans both.
+      self.assertEqual(range(ETL_SLICE), slices[0])
+      self.assertEqual(range(ETL_SLICE, 2 * ETL_SLICE), slices[1])
+      self.assertEqual(None, Batch.get(first.key()))
+      second = Batch.get(second.key())
+      self.assertEqual(ETL_SLICE - 50, second.progress)
+
+      # A retry resumes from the progress stored.
+      pending = [(second, Tweet.from_batch(second)[second.progress:])]
+      process_slices(pending, time.time())
+      self.assertEqual(range(2 * ETL_SLICE, ETL_SLICE + 130), slices[2])
+      self.assertEqual([], pending)
+      self.assertEqual(None, Batch.get(second.key()))
+    finally:
+      tasks.process_records = original
+
+  def test_inline_etl(self):
+    timeline = simplejson.dumps([{
+        "id": 7,
+        "text": "Inline",
+        "created_at": "Mon Aug 10 21:24:24 +0000 2009",
+        "user": {
+          "profile_image_url": "http://example.com/",
+          "screen_name": "inliner",
+          "followers_count": 1,
+          "friends_count": 1,
+          },
+        }])
+    processed = []
+    def fetch_timelines(urls):
+      return [timeline]
+    def process_records(records):
+      processed.append([record.id for record in records])
+
+    def fetch():
+      handler = tasks.Fetch()
+      handler.initialize(
+          webapp.Request.blank('/tasks/fetch?urls=http://example.com/'),
+          webapp.Response()
+          )
+      handler.post()
+
+    def new_batches():
+      return [batch for batch in Batch.all().fetch(1000)
+              if batch.key() not in existing]
+
+    existing = set(Batch.all(keys_only=True).fetch(1000))
+    originals = (tasks.fetch_timelines, tasks.process_records,
+                 tasks.INLINE_BUDGET)
+    tasks.fetch_timelines = fetch_timelines
+    tasks.process_records = process_records
+    try:
+      # Only a value which turns the setting on processes inline.
+      for value in ['off', 'false', '0']:
+        Settings(key_name='key:inline_etl', value=value).put()
+        Settings.flush('inline_etl')
+        fetch()
+      self.assertEqual([], processed)
+      batches = new_batches()
+      self.assertEqual(3, len(batches))
+      db.delete(batches)
+
+      Settings(key_name='key:inline_etl', value='On').put()
+      Settings.flush('inline_etl')
+      fetch()
+      self.assertEqual([[7]], processed)
+      self.assertEqual([], new_batches())
+
+      # A fetch which took longer than the budget stores a Batch.
+      tasks.INLINE_BUDGET = -1
+      fetch()
+      self.assertEqual([[7]], processed)
+      batches = new_batches()
+      self.assertEqual(1, len(batches))
+      self.assertEqual(
+          [7], [record.id for record in Tweet.from_batch(batches[0])]
+          )
+      db.delete(batches)
+    finally:
+      tasks.fetch_timelines, tasks.process_records, tasks.INLINE_BUDGET = \
+          originals
+      db.delete(db.Key.from_path('Settings', 'key:inline_etl'))
+      Settings.flush('inline_etl')
+
+  def test_claim_batches(self):
+    batches = []
+    for n in range(3):
+      batch = Batch.from_items([{
+          "id": n,
+          "text": "Claim %d" % n,
+          "created_at": "Mon Aug 10 21:24:24 +0000 2009",
+          "user": {
+            "profile_image_url": "http://example.com/",
+            "screen_name": "claimer",
+            "followers_count": 1,
+            "friends_count": 1,
+            },
+          }])
+      # Older than any other pending Batch, so they are claimed first.
+      batch.created_at = datetime(2000, 1, 1, 0, 0, n)
+      batches.append(batch)
+    db.put(batches)
+    first, second, third = batches
+    ids = [batch.key().id() for batch in batches]
+    claims = ['etl-claim:%d' % id for id in ids]
+
+    # A task claims its Batch, and the other pending ones, oldest first.
+    claimed = claim_batches(second)
+    self.assertEqual(
+        ids, [batch.key().id() for batch in claimed if batch.key().id() in ids]
+        )
+    self.assertEqual([], claim_batches(first))
+    self.assertEqual([], claim_batches(third))
+    release_batches(claimed)
+    self.assertEqual({}, memcache.get_multi(claims))
+
+    processed = []
+    retries = []
+    def process_records(records):
+      processed.extend([record.id for record in records])
+    def retry_claim(batch_id, attempt, retry):
+      retries.append((batch_id, attempt, retry))
+
+    def etl(batch, retry=0):
+      handler = tasks.ETL()
+      handler.initialize(
+          webapp.Request.blank('/tasks/etl?batch_id=%d&retry=%d' % (
+              batch.key().id(), retry
+              )),
+          webapp.Response()
+          )
+      handler.post()
+
+    originals = (tasks.process_records, tasks.retry_claim)
+    tasks.process_records = process_records
+    tasks.retry_claim = retry_claim
+    try:
+      # A Batch claimed by another task is retried later, not dropped.
+      memcache.add(claims[0], True)
+      etl(first)
+      self.assertEqual([], processed)
+      self.assertEqual([(ids[0], 0, 1)], retries)
+      self.assertNotEqual(None, Batch.get(first.key()))
+
+      # The other Batches drain, and their claims are released.
+      etl(second)
+      self.assertEqual([1, 2], processed[:2])
+      del processed[:]
+      self.assertEqual([None, None], Batch.get([second.key(), third.key()]))
+      self.assertEqual({claims[0]: True}, memcache.get_multi(claims))
+
+      # Once the claim is released, the retry processes the Batch.
+      release_batches([first])
+      etl(first, retries[0][2])
+      self.assertEqual([0], processed[:1])
+      self.assertEqual(None, Batch.get(first.key()))
+      self.assertEqual(1, len(retries))
+      self.assertEqual({}, memcache.get_multi(claims))
+    finally:
+      tasks.process_records, tasks.retry_claim = originals
+      db.delete(batches)
+      release_batches(batches)
+
+  def test_truncate_topics(self):
+    full, quiet = [Topic.from_tokens(name)[-1] for name in ["anakin", "luke"]]
+    db.put([full, quiet])
+    start = datetime(2009, 8, 10)
+    tweets = []
+    for n in range(MAX_TWEETS + 5):
+      tweets.append(Tweet(
+          key_name='tweet:%d' % n, content="Tweet %d" % n,
+          created_at=start + timedelta(0, n), pic_url="http://example.com/",
+          author="author", source_id=str(n), topics=[full.key()],
+          influence="%020d|%d" % (100 - n, n)
+          ))
+    tweets[-1].topics.append(quiet.key())
+    db.put(tweets)
+    TopicSnapshot.update({str(full.key()): [], str(quiet.key()): []})
+
+    self.assertEqual([], truncate_topics([str(full.key()), str(quiet.key())]))
+    # The Tweets deleted are removed from the snapshot. The oldest Tweets
+    # were the most influential, so none of those held are left.
+    full_snapshot = TopicSnapshot.get_by_key_name(str(full.key()))
+    self.assertEqual(
+        [str(n) for n in range(MAX_TWEETS + 4, MAX_TWEETS / 2 + 4, -1)],
+        [tweet.source_id for tweet in full_snapshot.tweets('-created_at')]
+        )
+    self.assertEqual([], full_snapshot.tweets('-influence'))
+    self.failIf(full_snapshot.complete)
+    quiet_snapshot = TopicSnapshot.get_by_key_name(str(quiet.key()))
+    self.assertEqual(1, len(quiet_snapshot.tweets('-created_at')))
+    self.assertTrue(quiet_snapshot.complete)
+    newest = Tweet.all().filter('topics =', full.key()).order('created_at')
+    self.assertEqual(MAX_TWEETS / 2, newest.count())
+    self.assertEqual(
+        str(MAX_TWEETS + 5 - MAX_TWEETS / 2), newest.get().source_id
+        )
+    self.assertEqual(1, Tweet.all().filter('topics =', quiet.key()).count())
+    self.assertEqual(
+        {str(full.key()): MAX_TWEETS / 2, str(quiet.key()): 1},
+        memcache.get_multi(
+            [str(full.key()), str(quiet.key())], key_prefix='stored:'
+            )
+        )
+
+    db.delete(Tweet.all(keys_only=True).fetch(MAX_TWEETS))
+    db.delete([full, quiet, full_snapshot, quiet_snapshot])
+
+  def test_sweep(self):
+    kept, gone = [Topic.from_tokens(name)[-1] for name in ["leia", "alderaan"]]
+    db.put([kept, gone])
+    start = datetime(2009, 8, 10)
+    tweets = []
+    for n, topics in enumerate([[kept], [gone], [kept, gone], [gone]]):
+      tweets.append(Tweet(
+          key_name='tweet:%d' % n, content="Tweet %d" % n,
+          created_at=start + timedelta(n), pic_url="http://example.com/",
+          author="author", source_id=str(n),
+          topics=[topic.key() for topic in topics]
+          ))
+    db.put(tweets)
+    db.delete(gone)
+    key = str(kept.key())
+    TopicSnapshot.update({key: []})
+    memcache.delete('generation:' + key)
+
+    self.assertEqual(None, sweep_old(start + timedelta(2), None, time.time()))
+    # The Tweets deleted are removed from the snapshot, and its Topic is
+    # marked as changed.
+    snapshot = TopicSnapshot.get_by_key_name(key)
+    self.assertEqual(
+        ['2'], [tweet.source_id for tweet in snapshot.tweets('-created_at')]
+        )
+    self.assertEqual(start + timedelta(2), snapshot.oldest)
+    self.failIf(memcache.get('generation:' + key) is None)
+
+    self.assertEqual(None, sweep_orphans(None, time.time()))
+    tweets = Tweet.all().order('created_at').fetch(10)
+    self.assertEqual(['tweet:2'], [tweet.key().name() for tweet in tweets])
+    self.assertEqual([kept.key()], tweets[0].topics)
+
+    db.delete(tweets + [kept, snapshot])
+
+  def test_fetch_timelines(self):
+    try:
+      urlfetch.fetch(STANDIN_URL + '/public.json')
+    except urlfetch_errors.DownloadError:
+      logging.warning("Skipped, run test/standin_server.py to test fetching.")
+      return
+
+    urls = [STANDIN_URL + path for path in TIMELINES.keys()]
+    urls.append(STANDIN_URL + '/missing.json')
+    urls.append(STANDIN_URL + '/public.json?delay=1')
+    contents = fetch_timelines(urls, deadline=5)
+    self.assertEqual(len(TIMELINES) + 1, len(contents))
+
+    items = merge_timelines(contents)
+    self.assertEqual([1, 2, 3, 4, 5], sorted([item['id'] for item in items]))
+
+    # The slow timeline is dropped, the others are kept.
+    urls[-1] = STANDIN_URL + '/friends.json?delay=3'
+    contents = fetch_timelines(urls, deadline=1)
+    self.assertEqual(len(TIMELINES), len(contents))
+
+if __name__ == '__main__':
+  unittest.main()